@@ -2,6 +2,44 @@
 EZID plugin admin module
 """
 from django.contrib import admin
-from plugins.ezid.models import RepoEZIDSettings
+from plugins.ezid.models import (
+    RepoEZIDSettings,
+    IssueDoiRefreshHistory,
+    EzidOutbox,
+    JournalDoiRefreshJob,
+)
+
+
+class IssueDoiRefreshHistoryAdmin(admin.ModelAdmin):
+    """Lists issue refreshes with their progress counters"""
+    list_display = ('id', 'issue', 'date_refresh', 'status', 'total_articles',
+                    'processed', 'succeeded', 'failed', 'aborted', 'unchanged',
+                    'deferred', 'network_seconds', 'local_seconds')
+    list_filter = ('status',)
+    list_select_related = ('issue',)
+    raw_id_fields = ('issue',)
+
+
+class JournalDoiRefreshJobAdmin(admin.ModelAdmin):
+    """Lists journal refreshes with their chunk and article counters"""
+    list_display = ('id', 'journal', 'date_refresh', 'status', 'total_chunks',
+                    'completed_chunks', 'failed_chunks', 'total_issues',
+                    'total_articles', 'succeeded', 'failed', 'unchanged', 'deferred')
+    list_filter = ('status',)
+    list_select_related = ('journal',)
+    raw_id_fields = ('journal',)
+
+
+class EzidOutboxAdmin(admin.ModelAdmin):
+    """Lists the DOI requests queued by the hooks"""
+    list_display = ('id', 'action', 'preprint', 'status', 'attempts',
+                    'date_created', 'next_attempt', 'date_completed')
+    list_filter = ('status', 'action')
+    list_select_related = ('preprint',)
+    raw_id_fields = ('preprint',)
+
 
 admin.site.register(RepoEZIDSettings)
+admin.site.register(IssueDoiRefreshHistory, IssueDoiRefreshHistoryAdmin)
+admin.site.register(JournalDoiRefreshJob, JournalDoiRefreshJobAdmin)
+admin.site.register(EzidOutbox, EzidOutboxAdmin)
@@ -0,0 +1,260 @@
+"""
+Benchmark of the journal DOI deposit pipeline.
+
+Synthetic journals, issues and articles are generated from a seed, with
+author counts and abstract lengths spread like real ones, and every stage
+of a deposit is timed on them: loading the articles, get_journal_metadata,
+prepare_payload, send_request against the local EZID stand-in, history
+writes and a full refresh_issue_doi.  Each stage records its wall time,
+per-item percentiles, database queries and peak traced memory.
+
+Everything runs in a transaction that is rolled back at the end, so the
+synthetic data never reaches the database.
+"""
+
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import django
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from identifiers.models import Identifier
+from journal.models import Journal
+from submission.models import Article, FrozenAuthor
+from utils import setting_handler
+from utils.testing import helpers
+
+from plugins.ezid import logic, ratelimit, tasks, transport
+from plugins.ezid.models import IssueDoiRefreshHistory, TaskStatus
+from plugins.ezid.stub import StubEzid
+
+WORDS = (
+    "analysis archive assessment behavior boundary california climate community "
+    "comparative data design development dynamics education environment evidence "
+    "experimental framework health history identity impact institutional language "
+    "learning literature media memory method migration model network policy "
+    "political population practice process public regional research resource "
+    "response review social spatial structure study system theory urban variation"
+).split()
+
+DOI_PREFIX = "10.99999"
+SHOULDER = "bench."
+
+def text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(max(1, words))).capitalize()
+
+def author_count(rng, max_authors):
+    ''' mostly one to six authors, with a long tail of large collaborations '''
+    return min(max_authors, max(1, int(rng.lognormvariate(1.1, 0.7))))
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True, text=True, check=True, timeout=10,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def create_journal(rng, code, endpoint_url, issues, articles, abstract_words, max_authors): # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    ''' a journal set up for EZID and its issues of published articles '''
+    journal = Journal(code=code, domain=f"{code}.example.org")
+    journal.save()
+    for prefix, name, value in (
+        ('general', 'journal_name', f"Benchmark Journal {code}"),
+        ('general', 'journal_issn', "1111-1111"),
+        ('Identifiers', 'crossref_name', "benchmark"),
+        ('Identifiers', 'crossref_email', "benchmark@example.org"),
+        ('Identifiers', 'crossref_registrant', "benchmark"),
+        ('plugin:ezid', 'ezid_plugin_endpoint_url', endpoint_url),
+        ('plugin:ezid', 'ezid_plugin_username', "benchmark"),
+        ('plugin:ezid', 'ezid_plugin_password', "benchmark"),
+    ):
+        setting_handler.save_setting(prefix, name, journal, value)
+
+    created = []
+    for number in range(1, issues + 1):
+        issue_articles = []
+        for _ in range(articles):
+            # lengths vary around the requested size like real abstracts do
+            words = int(rng.gauss(abstract_words, abstract_words / 3))
+            issue_articles.append(Article.objects.create(
+                journal=journal,
+                title=text(rng, rng.randint(6, 20)),
+                abstract=text(rng, words),
+                stage="Published",
+                date_published=timezone.now(),
+                remote_url=f"https://escholarship.org/uc/item/{rng.getrandbits(32):08x}",
+            ))
+        FrozenAuthor.objects.bulk_create([
+            FrozenAuthor(
+                article=article,
+                first_name=text(rng, 1),
+                last_name=text(rng, 1),
+                institution=text(rng, 3),
+                order=order,
+            )
+            for article in issue_articles
+            for order in range(author_count(rng, max_authors))
+        ])
+        Identifier.objects.bulk_create([
+            Identifier(id_type="doi", identifier=f"{DOI_PREFIX}/{SHOULDER}{article.pk}",
+                       article=article)
+            for article in issue_articles
+        ])
+        issue = helpers.create_issue(journal, vol=1, number=number, articles=issue_articles)
+        Article.objects.filter(pk__in=[a.pk for a in issue_articles]).update(primary_issue=issue)
+        created.append(issue)
+    return journal, created
+
+
+class Benchmark:
+    """Runs the stages and collects one result per stage"""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, items):
+        result = {'stage': name, 'items': items, 'samples': []}
+        queries = [0]
+
+        def count_queries(execute, sql, params, many, context): # pylint: disable=too-many-arguments,too-many-positional-arguments
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_queries):
+                yield result
+        finally:
+            seconds = time.perf_counter() - started
+            if self.trace_memory:
+                _current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                result['peak_memory_kib'] = round(peak / 1024, 1)
+            samples = result.pop('samples')
+            result['seconds'] = round(seconds, 4)
+            result['per_item_ms'] = round(seconds * 1000 / max(1, items), 3)
+            if samples:
+                result['p50_ms'] = round(tasks.percentile(samples, 0.5) * 1000, 3)
+                result['p95_ms'] = round(tasks.percentile(samples, 0.95) * 1000, 3)
+            result['queries'] = queries[0]
+            self.stages.append(result)
+
+    def timed(self, result, func, *args, **kwargs):
+        started = time.perf_counter()
+        value = func(*args, **kwargs)
+        result['samples'].append(time.perf_counter() - started)
+        return value
+
+    def run(self, issues):
+        article_ids = [
+            [article.pk for article in issue.get_sorted_articles()] for issue in issues
+        ]
+        total = sum(len(ids) for ids in article_ids)
+
+        with self.stage("load_articles", total):
+            articles = [logic.load_articles(ids) for ids in article_ids]
+        articles = [article for chunk in articles for article in chunk]
+
+        config_cache = logic.JournalConfigCache()
+        with self.stage("get_journal_metadata", total) as result:
+            metadata = [
+                self.timed(result, logic.get_journal_metadata, article,
+                           config_cache.get(article.journal))
+                for article in articles
+            ]
+
+        with self.stage("prepare_payload", total) as result:
+            payloads = []
+            for article, ezid_metadata in zip(articles, metadata):
+                config = config_cache.get(article.journal)
+                ezid_metadata['update_id'] = ezid_metadata['doi']
+                payloads.append(self.timed(
+                    result, logic.prepare_payload, ezid_metadata, config.template,
+                    ezid_metadata['target_url'], config.registrant,
+                ))
+
+        with self.stage("send_request", total) as result:
+            for article, ezid_metadata, payload in zip(articles, metadata, payloads):
+                config = config_cache.get(article.journal)
+                self.timed(
+                    result, logic.send_request, "PUT",
+                    f"id/doi:{logic.encode(ezid_metadata['doi'])}", payload,
+                    config.username, config.password, config.endpoint_url,
+                )
+
+        with self.stage("history_writes", total) as result:
+            for issue in issues:
+                issue_articles = [a for a in articles if a.primary_issue_id == issue.pk]
+                issueh = IssueDoiRefreshHistory.objects.create(issue=issue)
+                writer = tasks.HistoryWriter(issueh, issue_articles)
+                for article in issue_articles:
+                    self.timed(result, writer.record, article, TaskStatus.SUCCESS, "benchmark")
+                writer.flush()
+
+        with self.stage("refresh_issue_doi", total) as result:
+            for issue in issues:
+                issueh = IssueDoiRefreshHistory.objects.create(issue=issue)
+                # the synthetic data is not committed, other connections cannot see it
+                self.timed(result, tasks.refresh_issue_doi, issueh.pk, workers=1)
+
+        return self.stages
+
+
+def run_benchmark(journals=1, issues=2, articles=50, abstract_words=200, max_authors=60, # pylint: disable=too-many-arguments,too-many-locals
+                  latency=0.005, error_rate=0.0, seed=1, trace_memory=True):
+    ''' generates the data, runs every stage and rolls it all back, returns the results '''
+    rng = random.Random(seed)
+    parameters = {
+        'journals': journals, 'issues': issues, 'articles': articles,
+        'abstract_words': abstract_words, 'max_authors': max_authors,
+        'latency': latency, 'error_rate': error_rate, 'seed': seed,
+        'trace_memory': trace_memory,
+    }
+    transport.close_transports()
+    ratelimit.reset_rate_limiters()
+    # the stand-in is local, the client side rate limit would only measure itself
+    with StubEzid("benchmark", "benchmark", latency=latency, error_rate=error_rate,
+                  seed=seed) as ezid, \
+            override_settings(EZID_RATE_LIMIT=100000, EZID_RATE_BURST=100000,
+                              EZID_RETRY_BACKOFF=0):
+        with transaction.atomic():
+            started = time.perf_counter()
+            issue_list = []
+            for number in range(journals):
+                _journal, created = create_journal(
+                    rng, f"ezidbench{seed}x{number}", ezid.url, issues, articles,
+                    abstract_words, max_authors,
+                )
+                issue_list.extend(created)
+            setup_seconds = time.perf_counter() - started
+            stages = Benchmark(trace_memory).run(issue_list)
+            transaction.set_rollback(True)
+        requests = ezid.requests
+        transport.close_transports()
+    ratelimit.reset_rate_limiters()
+
+    return {
+        'commit': git_commit(),
+        'date': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'parameters': parameters,
+        'setup_seconds': round(setup_seconds, 3),
+        'ezid_requests': requests,
+        'stages': stages,
+    }
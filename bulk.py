@@ -0,0 +1,178 @@
+"""
+Helpers shared by the bulk DOI management commands.
+
+Items are handed to worker threads in chunks through a bounded queue, and
+every outcome is appended to a JSON lines results file that a later run
+can read to resume or to retry the failures.
+"""
+
+import json
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import CommandError
+from django.db import connections
+from django.utils import timezone
+
+from journal.models import Issue, Journal
+from submission.models import Article
+
+# statuses in the results file that need no further work
+DONE = ('success', 'unchanged')
+
+def read_ids(stream):
+    ''' ids, one per line, skipping blank lines and # comments '''
+    ids = []
+    for number, line in enumerate(stream, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            ids.append(int(line))
+        except ValueError as e:
+            raise CommandError(f"Line {number} is not an id: {line}") from e
+    return ids
+
+def collect_article_ids(article_ids, id_file=None, journal_code=None, issue_id=None):
+    '''
+    article ids from the arguments, a file (- for stdin), the published
+    articles of a journal and the articles of an issue, without duplicates
+    '''
+    ids = list(article_ids)
+    if id_file == '-':
+        ids.extend(read_ids(sys.stdin))
+    elif id_file:
+        with open(id_file, encoding="UTF-8") as stream:
+            ids.extend(read_ids(stream))
+    if journal_code:
+        try:
+            journal = Journal.objects.get(code=journal_code)
+        except Journal.DoesNotExist as e:
+            raise CommandError(f"Journal {journal_code} does not exist.") from e
+        ids.extend(Article.objects.filter(
+            journal=journal, stage="Published",
+        ).order_by('pk').values_list('pk', flat=True))
+    if issue_id:
+        try:
+            issue = Issue.objects.get(pk=issue_id)
+        except Issue.DoesNotExist as e:
+            raise CommandError(f"Issue {issue_id} does not exist.") from e
+        ids.extend(article.pk for article in issue.get_sorted_articles())
+    # first occurrence wins, the order is kept
+    return list(dict.fromkeys(ids))
+
+def read_results(path, key='article_id'):
+    ''' the last recorded status of every item in a results file '''
+    statuses = {}
+    try:
+        with open(path, encoding="UTF-8") as results:
+            for line in results:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # a line cut short when the previous run was killed
+                    continue
+                statuses[result[key]] = result['status']
+    except FileNotFoundError:
+        pass
+    return statuses
+
+def result(key, pk, action, status, message, **extra):
+    ''' one line of a results file '''
+    return {
+        key: pk,
+        'action': action,
+        'status': status,
+        'message': str(message).strip(),
+        'time': timezone.now().isoformat(),
+        **extra,
+    }
+
+def error_result(key, pk, action, error, **extra):
+    return result(key, pk, action, 'failure', f"error: {error.__class__.__name__}: {error}", **extra)
+
+def run_in_workers(chunks, process_chunk, workers, on_error):
+    '''
+    calls process_chunk for every chunk from up to `workers` threads, the
+    chunks are pulled from `chunks` as the workers need them, so it can be
+    a generator streaming from the database
+    '''
+    if workers <= 1:
+        for chunk in chunks:
+            process_chunk(chunk)
+        return
+
+    chunk_queue = queue.Queue(maxsize=workers * 2)
+
+    def work():
+        try:
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
+                try:
+                    process_chunk(chunk)
+                except Exception as e: # pylint: disable=broad-exception-caught
+                    # keep draining the queue, or the producer blocks for good
+                    on_error(chunk, e)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in chunks:
+            chunk_queue.put(chunk)
+    finally:
+        for _ in threads:
+            chunk_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+class ResultsLog:
+    """Appends one JSON line per item and reports progress as it goes"""
+
+    def __init__(self, path, total, stdout, noun="articles", interval=2.0): # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.file = open(path, "a", encoding="UTF-8") # pylint: disable=consider-using-with
+        self.total = total
+        self.stdout = stdout
+        self.noun = noun
+        self.interval = interval
+        self.counts = Counter()
+        self.done = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self._lock = threading.Lock()
+
+    def record(self, outcome):
+        line = json.dumps(outcome, ensure_ascii=False)
+        with self._lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.counts[outcome['status']] += 1
+            self.done += 1
+            now = time.monotonic()
+            if now - self.last_report >= self.interval or self.done == self.total:
+                self.last_report = now
+                self.stdout.write(self.progress(now))
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        return ", ".join(f"{status} {count}" for status, count in sorted(self.counts.items()))
+
+    def progress(self, now):
+        elapsed = max(now - self.started, 1e-6)
+        rate = self.done / elapsed
+        remaining = (self.total - self.done) / rate if rate else 0
+        return (f"{self.done}/{self.total} {self.noun}, {rate:.1f}/s, "
+                f"ETA {remaining:.0f}s ({self.summary()})")
+
+    def close(self):
+        self.file.close()
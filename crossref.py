@@ -0,0 +1,375 @@
+"""
+Compiled builders for the crossref documents sent to EZID.
+
+Each builder writes the same document as the matching template in
+templates/ezid after `prepare_payload` collapses its whitespace, but
+without going through the template engine.  Variables are resolved,
+filtered and escaped exactly as the template engine does it, and
+whitespace is collapsed piece by piece as it is written.
+"""
+
+import re
+
+from django.template import defaultfilters
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.timezone import template_localtime
+
+from plugins.ezid.templatetags.normalize_orcid import normalize_orcid
+
+_re_whitespace = re.compile(r"\s+")
+
+DOI_BATCH_OPEN = (
+    '<?xml version="1.0" encoding="UTF-8"?> '
+    '<doi_batch xmlns="http://www.crossref.org/schema/5.3.1" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="5.3.1" '
+    'xsi:schemaLocation="http://www.crossref.org/schema/5.3.1 '
+    'http://www.crossref.org/schemas/crossref5.3.1.xsd"> '
+)
+
+POSTED_CONTENT_OPEN = (
+    '<?xml version="1.0"?> '
+    '<posted_content xmlns="http://www.crossref.org/schema/4.4.0" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xmlns:jats="http://www.ncbi.nlm.nih.gov/JATS1" '
+    'xsi:schemaLocation="http://www.crossref.org/schema/4.4.0 '
+    'http://www.crossref.org/schema/deposit/crossref4.4.0.xsd" type="preprint"> '
+)
+
+
+class Invalid:
+    """Result of a variable lookup that failed, renders as an empty string"""
+    def __bool__(self):
+        return False
+
+    def __str__(self):
+        return ""
+
+INVALID = Invalid()
+
+
+def lookup(current, *bits):
+    ''' resolves a dotted variable the way the template engine does '''
+    for bit in bits:
+        try:
+            try:
+                current = current[bit]
+            except (TypeError, AttributeError, KeyError, ValueError, IndexError):
+                current = getattr(current, bit)
+            if callable(current):
+                if getattr(current, "do_not_call_in_templates", False):
+                    pass
+                elif getattr(current, "alters_data", False):
+                    return INVALID
+                else:
+                    current = current()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            if isinstance(e, (TypeError, AttributeError)) or getattr(e, "silent_variable_failure", False):
+                return INVALID
+            raise
+    return current
+
+def render(value):
+    ''' renders a value as {{ value }} would with autoescaping on '''
+    if value is INVALID:
+        return ""
+    return conditional_escape(localize(template_localtime(value)))
+
+def clean_text(value):
+    ''' the striptags and escape filters '''
+    return conditional_escape(defaultfilters.striptags(str(value)))
+
+def format_date(value, fmt):
+    ''' the date filter '''
+    if value is INVALID:
+        return ""
+    return defaultfilters.date(template_localtime(value), fmt)
+
+def sequence(first):
+    return 'sequence="first"' if first else 'sequence="additional"'
+
+
+class CrossrefWriter:
+    """
+    Buffer for a crossref document that collapses whitespace on write,
+    so the joined output never needs a whole-document pass.
+    """
+    def __init__(self):
+        self._parts = []
+        self._space = True  # drop leading whitespace, like strip()
+
+    def _append(self, text):
+        if self._space and text[0] == " ":
+            text = text[1:]
+            if not text:
+                return
+        self._parts.append(text)
+        self._space = text[-1] == " "
+
+    def markup(self, text):
+        ''' appends template text, which contains single spaces only '''
+        if text:
+            self._append(text)
+
+    def text(self, value):
+        ''' appends an already rendered value, collapsing its whitespace '''
+        if value:
+            self._append(_re_whitespace.sub(" ", value))
+
+    def element(self, tag, value, attrs=""):
+        self.markup(f" <{tag}{attrs}>")
+        self.text(value)
+        self.markup(f"</{tag}> ")
+
+    def getvalue(self):
+        value = "".join(self._parts)
+        return value[:-1] if value.endswith(" ") else value
+
+
+def write_head(w, ctx):
+    article = ctx.get("article", INVALID)
+    now = ctx.get("now", INVALID)
+    journal_name = lookup(article, "journal", "name")
+    w.markup(" <head> <doi_batch_id>")
+    w.text(render(defaultfilters.cut(str(journal_name), " ")))
+    w.markup("_")
+    w.text(render(format_date(now, "Ymd")))
+    w.markup("_")
+    w.text(render(lookup(article, "pk")))
+    w.markup("</doi_batch_id> ")
+    w.element("timestamp", render(format_date(now, "U")))
+    w.markup(" <depositor> ")
+    w.element("depositor_name", render(ctx.get("depositor_name", INVALID)))
+    w.element("email_address", render(ctx.get("depositor_email", INVALID)))
+    w.markup(" </depositor> ")
+    w.element("registrant", render(ctx.get("registrant", INVALID)))
+    w.markup(" </head> ")
+
+def write_person_name(w, author, first):
+    w.markup(f' <person_name contributor_role="author" {sequence(first)}> ')
+    w.element("given_name", render(lookup(author, "given_names")))
+    w.element("surname", render(lookup(author, "last_name")))
+    orcid = lookup(author, "orcid")
+    if orcid:
+        w.element("ORCID", render(normalize_orcid(orcid)))
+    w.markup(" </person_name> ")
+
+def iterate(value):
+    if not value:
+        return []
+    return list(value)
+
+def write_collection(w, download_url):
+    w.markup(' <collection property="text-mining"> <item> ')
+    w.element("resource", download_url, ' mime_type="application/pdf"')
+    w.markup(" </item> </collection> ")
+
+def write_license(w, license_url):
+    w.markup(' <program xmlns="http://www.crossref.org/AccessIndicators.xsd"> <free_to_read/> ')
+    w.element("license_ref", render(license_url))
+    w.markup(" </program> ")
+
+def build_journal_content(ctx):
+    ''' ezid/journal_content.xml '''
+    w = CrossrefWriter()
+    article = ctx.get("article", INVALID)
+    w.markup(DOI_BATCH_OPEN)
+    write_head(w, ctx)
+
+    journal_name = render(lookup(article, "journal", "name"))
+    w.markup(" <body> <journal> <journal_metadata> ")
+    w.element("full_title", journal_name)
+    w.element("abbrev_title", journal_name)
+    issn = lookup(article, "journal", "issn")
+    if issn and issn != "0000-0000":
+        w.element("issn", render(issn), ' media_type="electronic"')
+    w.markup(" </journal_metadata> ")
+
+    if lookup(article, "issue"):
+        w.markup(' <journal_issue> <publication_date media_type="online"> ')
+        w.element("month", render(lookup(article, "issue", "date", "month")))
+        w.element("day", render(lookup(article, "issue", "date", "day")))
+        w.element("year", render(lookup(article, "issue", "date", "year")))
+        w.markup(" </publication_date> <journal_volume> ")
+        w.element("volume", render(lookup(article, "issue", "volume")))
+        w.markup(" </journal_volume> ")
+        w.element("issue", render(lookup(article, "issue", "issue")))
+        w.markup(" </journal_issue> ")
+
+    w.markup(' <journal_article publication_type="full_text"> <titles> ')
+    w.element("title", clean_text(ctx.get("title", "")))
+    w.markup(" </titles> ")
+
+    authors = iterate(ctx.get("authors", INVALID))
+    if authors:
+        w.markup(" <contributors> ")
+        for index, author in enumerate(authors):
+            if lookup(author, "is_corporate"):
+                w.markup(f' <organization contributor_role="author" {sequence(index == 0)}> ')
+                w.text(render(lookup(author, "institution")))
+                w.markup(" </organization> ")
+            else:
+                write_person_name(w, author, index == 0)
+        w.markup(" </contributors> ")
+
+    abstract = ctx.get("abstract", INVALID)
+    if abstract:
+        w.markup(' <abstract xmlns="http://www.ncbi.nlm.nih.gov/JATS1"> ')
+        w.element("p", clean_text(abstract))
+        w.markup(" </abstract> ")
+
+    if lookup(article, "date_published"):
+        w.markup(' <publication_date media_type="online"> ')
+        w.element("month", render(lookup(article, "date_published", "month")))
+        w.element("day", render(lookup(article, "date_published", "day")))
+        w.element("year", render(lookup(article, "date_published", "year")))
+        w.markup(" </publication_date> ")
+
+    license_url = ctx.get("license_url", INVALID)
+    if license_url:
+        write_license(w, license_url)
+
+    w.markup(" <doi_data> ")
+    doi = ctx.get("doi", INVALID)
+    if doi:
+        w.element("doi", render(doi))
+    w.element("resource", render(ctx.get("target_url", INVALID)))
+    download_url = lookup(ctx, "download_url")
+    if download_url:
+        write_collection(w, render(download_url))
+    w.markup(" </doi_data> </journal_article> </journal> </body> </doi_batch>")
+    return w.getvalue()
+
+def build_book_chapter(ctx):
+    ''' ezid/book_chapter.xml '''
+    w = CrossrefWriter()
+    article = ctx.get("article", INVALID)
+    w.markup(DOI_BATCH_OPEN)
+    write_head(w, ctx)
+
+    journal_name = render(lookup(article, "journal", "name"))
+    w.markup(' <body> <book book_type="edited_book"> '
+             '<book_series_metadata language="en"> <series_metadata> <titles> ')
+    w.element("title", journal_name)
+    w.markup(" </titles> ")
+    w.element("issn", render(lookup(article, "journal", "issn")))
+    w.markup(" </series_metadata> <titles> ")
+    w.element("title", journal_name)
+    w.markup(' </titles> <publication_date media_type="online"> ')
+    w.element("year", render(lookup(article, "issue", "date", "year")))
+    w.markup(' </publication_date> <noisbn reason="archive_volume"/> <publisher> '
+             '<publisher_name>eScholarship Publishing</publisher_name> '
+             '<publisher_place>Oakland,CA</publisher_place> </publisher> ')
+
+    license_url = ctx.get("license_url", INVALID)
+    if license_url:
+        write_license(w, license_url)
+
+    w.markup(' </book_series_metadata> <content_item component_type="chapter" '
+             'publication_type="full_text" language="en"> <contributors> ')
+    for index, author in enumerate(iterate(ctx.get("authors", INVALID))):
+        if lookup(author, "is_corporate"):
+            w.element("organization", render(lookup(author, "institution")))
+        else:
+            write_person_name(w, author, index == 0)
+    w.markup(" </contributors> <titles> ")
+    w.element("title", clean_text(lookup(article, "title")))
+    w.markup(" </titles> ")
+
+    abstract = lookup(article, "abstract")
+    if abstract:
+        w.markup(' <abstract xmlns="http://www.ncbi.nlm.nih.gov/JATS1"> ')
+        w.element("p", clean_text(abstract))
+        w.markup(" </abstract> ")
+
+    w.markup(' <publication_date media_type="online"> ')
+    w.element("month", render(lookup(article, "date_published", "month")))
+    w.element("day", render(lookup(article, "date_published", "day")))
+    w.element("year", render(lookup(article, "date_published", "year")))
+    w.markup(" </publication_date> <doi_data> ")
+    w.element("doi", render(ctx.get("doi", INVALID)))
+    w.element("resource", render(ctx.get("target_url", INVALID)))
+    download_url = lookup(ctx, "download_url")
+    if download_url:
+        write_collection(w, render(download_url))
+    w.markup(" </doi_data> </content_item> </book> </body> </doi_batch>")
+    return w.getvalue()
+
+def build_posted_content(ctx):
+    ''' ezid/posted_content.xml '''
+    w = CrossrefWriter()
+    now = ctx.get("now", INVALID)
+    w.markup(POSTED_CONTENT_OPEN)
+    w.element("group_title", conditional_escape(str(ctx.get("group_title", ""))))
+
+    contributors = ctx.get("contributors", INVALID)
+    if contributors:
+        w.markup(" <contributors> ")
+        # the template tests an undefined variable for corporate authors,
+        # so every contributor is written as a person
+        for index, contributor in enumerate(iterate(contributors)):
+            w.markup(f' <person_name contributor_role="author" {sequence(index == 0)}> ')
+            w.element("given_name", clean_text(lookup(contributor, "given_name")))
+            w.element("surname", clean_text(lookup(contributor, "surname")))
+            orcid = lookup(contributor, "ORCID")
+            if orcid:
+                w.element("ORCID", render(normalize_orcid(orcid)))
+            w.markup(" </person_name> ")
+        w.markup(" </contributors> ")
+
+    w.markup(" <titles> ")
+    w.element("title", clean_text(ctx.get("title", "")))
+    w.markup(" </titles> <posted_date> ")
+    w.element("month", render(lookup(now, "month")))
+    w.element("day", render(lookup(now, "day")))
+    w.element("year", render(lookup(now, "year")))
+    w.markup(" </posted_date> <acceptance_date> ")
+    accepted = ctx.get("accepted_date", INVALID) or now
+    w.element("month", render(lookup(accepted, "month")))
+    w.element("day", render(lookup(accepted, "day")))
+    w.element("year", render(lookup(accepted, "year")))
+    w.markup(" </acceptance_date> ")
+
+    abstract = ctx.get("abstract", INVALID)
+    if abstract:
+        w.markup(" <jats:abstract> ")
+        w.element("jats:p", clean_text(abstract))
+        w.markup(" </jats:abstract> ")
+
+    license_url = ctx.get("license_url", INVALID)
+    if license_url:
+        write_license(w, license_url)
+
+    published_doi = ctx.get("published_doi", INVALID)
+    if published_doi:
+        w.markup(" <!-- relationship established with VOR DOI (required when VOR is identified) -->"
+                 ' <program xmlns="http://www.crossref.org/relations.xsd"> <related_item> ')
+        w.element("intra_work_relation", render(published_doi),
+                  ' relationship-type="isPreprintOf" identifier-type="doi"')
+        w.markup(" </related_item> </program> ")
+
+    update_id = ctx.get("update_id", INVALID)
+    if update_id:
+        w.markup(" <doi_data> ")
+        w.element("doi", render(update_id))
+        w.element("resource", render(ctx.get("target_url", INVALID)))
+        w.markup(" </doi_data> ")
+    else:
+        w.markup(" <!-- placeholder DOI, will be overwritten when DOI is minted --> <doi_data> "
+                 "<doi>10.50505/preprint_sample_doi_2</doi> "
+                 "<resource>https://escholarship.org/</resource> ")
+        download_url = lookup(ctx, "download_url")
+        if download_url:
+            site_url = render(ctx.get("site_url", INVALID))
+            write_collection(w, f"{site_url}{render(download_url)}")
+        w.markup(" </doi_data> ")
+    w.markup(" </posted_content>")
+    return w.getvalue()
+
+
+# serializers by the template they stand in for
+BUILDERS = {
+    'ezid/journal_content.xml': build_journal_content,
+    'ezid/book_chapter.xml': build_book_chapter,
+    'ezid/posted_content.xml': build_posted_content,
+}
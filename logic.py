@@ -7,23 +7,58 @@ __author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
 __license__ = "BSD 3-Clause"
 __maintainer__ = "California Digital Library"
 
+import hashlib
 import re
+import threading
+import time
+from dataclasses import dataclass
 from urllib.parse import quote
-import urllib.request as urlreq
 
+from django.conf import settings
 from django.core.validators import URLValidator, ValidationError
 from django.utils import timezone
 from django.template.loader import render_to_string
 from django.contrib import messages
+from django.db import transaction
+from django.db.models import Prefetch
+from django_q.tasks import async_task
 
 from utils.logger import get_logger
 from utils import setting_handler
 from identifiers import logic as id_logic
+from identifiers.models import Identifier
+from submission.models import Article
 
-from plugins.ezid.models import RepoEZIDSettings
+from plugins.ezid import crossref, metrics
+from plugins.ezid.models import RepoEZIDSettings, DoiPayloadFingerprint, EzidOutbox
+from plugins.ezid.transport import get_transport
 
 logger = get_logger(__name__)
 
+UNCHANGED = "Metadata unchanged since the last successful deposit"
+
+# the task that sends queued DOI requests, by name as tasks imports this module
+OUTBOX_TASK = 'plugins.ezid.tasks.send_outbox_entry'
+
+# used to normalize xml output by collapsing all whitespace to a single space
+_re_combine_whitespace = re.compile(r"\s+")
+
+# batch id and timestamp change on every render, even when the metadata does not
+_re_volatile_head = re.compile(r"<doi_batch_id>.*?</doi_batch_id>|<timestamp>.*?</timestamp>")
+
+def add_timing(timings, stage, started):
+    ''' adds the seconds since `started` to a stage of `timings`, when one is passed '''
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - started
+
+@dataclass(frozen=True)
+class EzidRequest:
+    """A request ready to be sent to EZID"""
+    method: str
+    path: str
+    payload: str
+    doi: str
+
 def get_license_url(article):
     if article and article.license and article.license.url :
         url = article.license.url
@@ -86,56 +121,114 @@ def is_valid_url(url):
     except ValidationError:
         return False
 
-class EzidHTTPErrorProcessor(urlreq.HTTPErrorProcessor):
-    ''' Error Processor, required to let 201 responses pass '''
-    def http_response(self, request, response):
-        if response.code == 201:
-            my_return = response
-        else:
-            my_return = urlreq.HTTPErrorProcessor.http_response(self, request, response)
-        return my_return
-    https_response = http_response
+def request_action(method, path):
+    ''' the DOI action of a request, for the metrics '''
+    if path.startswith("shoulder/"):
+        return "mint"
+    if method == "PUT":
+        return "register"
+    return "update"
 
 # Send request should be refactored to reduce the number of arguments
 # But I'm concentrating on simpler refactoring for now
 def send_request(method, path, data, username, password, endpoint_url): # pylint: disable=too-many-arguments,too-many-positional-arguments
-    ''' sends a request to EZID '''
+    ''' sends a request to EZID over the shared keep-alive transport, returns an EzidResult '''
     # Sent PUT for both create and update for Journal dois
     if method == 'PUT':
-        request_url = f"{endpoint_url}/{path}?update_if_exists=yes"
-    else:
-        request_url = f"{endpoint_url}/{path}"
-
-    opener = urlreq.build_opener(EzidHTTPErrorProcessor())
-    ezid_handler = urlreq.HTTPBasicAuthHandler()
-    ezid_handler.add_password("EZID", endpoint_url, username, password)
-    opener.add_handler(ezid_handler)
-
-    request = urlreq.Request(request_url)
-    request.get_method = lambda: method
-    request.add_header("Content-Type", "text/plain; charset=UTF-8")
-    request.data = data.encode("UTF-8")
-
-    try:
-        connection = opener.open(request)
-        response = connection.read()
-        return response.decode("UTF-8")
-
-    except urlreq.HTTPError as ezid_error:
-        if ezid_error.fp is not None:
-            response = ezid_error.fp.read().decode("utf-8")
-            if not response.endswith("\n"):
-                response += "\n"
-        return response
+        path = f"{path}?update_if_exists=yes"
+
+    action = request_action(method, path)
+    transport = get_transport(endpoint_url, username, password)
+    started = time.perf_counter()
+    with metrics.in_flight():
+        result = transport.request(method, path, data.encode("UTF-8"))
+    metrics.observe('ezid_request_duration_seconds', time.perf_counter() - started, action=action)
+    metrics.inc('ezid_requests_total', action=action, outcome=result.error_class or "success")
+    metrics.inc('ezid_request_attempts_total', result.attempts, action=action)
+    if not result.ok and not result.endswith("\n"):
+        result = result.with_text(result + "\n")
+    return result
+
+def render_metadata(template, ezid_metadata, serializer=None):
+    ''' renders the crossref xml with the template engine or the compiled builder '''
+    if serializer is None:
+        serializer = getattr(settings, 'EZID_PAYLOAD_SERIALIZER', 'template')
+    if serializer == 'builder' and template in crossref.BUILDERS:
+        return crossref.BUILDERS[template](ezid_metadata)
+    return _re_combine_whitespace.sub(" ", render_to_string(template, ezid_metadata)).strip()
 
 def prepare_payload(ezid_metadata, template, target_url, owner):
-    # normalize xml output by collapsing all whitespace to a single space
-    _re_combine_whitespace = re.compile(r"\s+")
-    metadata = _re_combine_whitespace.sub(" ", render_to_string(template, ezid_metadata)).strip()
+    metadata = render_metadata(template, ezid_metadata)
     payload = (f"crossref: {metadata}\n_crossref: yes\n"
                f"_profile: crossref\n_target: {target_url}\n_owner: {owner}")
     return payload
 
+def payload_fingerprint(payload):
+    ''' hash of a payload, ignoring the parts that change on every render '''
+    stable = _re_volatile_head.sub("", payload)
+    return hashlib.sha256(stable.encode("UTF-8")).hexdigest()
+
+def is_payload_unchanged(doi, fingerprint, fingerprints=None):
+    if fingerprints is not None:
+        return fingerprints.is_unchanged(doi, fingerprint)
+    return DoiPayloadFingerprint.objects.filter(doi=doi, fingerprint=fingerprint).exists()
+
+def save_payload_fingerprint(doi, fingerprint, fingerprints=None):
+    ''' with `fingerprints`, kept for its next bulk write instead '''
+    if fingerprints is not None:
+        fingerprints.sent(doi, fingerprint)
+        return
+    DoiPayloadFingerprint.objects.update_or_create(
+        doi=doi,
+        defaults={'fingerprint': fingerprint},
+    )
+
+class PayloadFingerprints:
+    """
+    The stored payload fingerprints of a job's DOIs, loaded in one query.
+    The fingerprints of the payloads sent meanwhile are kept until write()
+    stores them all in one bulk upsert.
+    """
+    def __init__(self, dois):
+        self.stored = {
+            doi: (fingerprint, date_sent)
+            for doi, fingerprint, date_sent in DoiPayloadFingerprint.objects.filter(
+                doi__in=dois).values_list('doi', 'fingerprint', 'date_sent')
+        }
+        self._sent = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_articles(cls, articles):
+        return cls([doi for doi in map(get_article_doi, articles) if doi])
+
+    def is_unchanged(self, doi, fingerprint):
+        with self._lock:
+            stored = self.stored.get(doi)
+        return stored is not None and stored[0] == fingerprint
+
+    def date_sent(self, doi):
+        with self._lock:
+            stored = self.stored.get(doi)
+        return stored[1] if stored else None
+
+    def sent(self, doi, fingerprint):
+        with self._lock:
+            self._sent[doi] = fingerprint
+            self.stored[doi] = (fingerprint, timezone.now())
+
+    def write(self):
+        with self._lock:
+            sent, self._sent = self._sent, {}
+        if sent:
+            DoiPayloadFingerprint.objects.bulk_create(
+                [DoiPayloadFingerprint(doi=doi, fingerprint=fingerprint)
+                 for doi, fingerprint in sent.items()],
+                update_conflicts=True,
+                unique_fields=['doi'],
+                update_fields=['fingerprint', 'date_sent'],
+            )
+
 def process_ezid_result(item, action, ezid_result, request):
     if isinstance(ezid_result, str):
         if ezid_result.startswith('success:'): # pylint: disable=no-else-return
@@ -146,7 +239,10 @@ def process_ezid_result(item, action, ezid_result, request):
                 messages.success(request, msg)
             return doi
         else:
+            error_class = getattr(ezid_result, 'error_class', None)
             msg = f'EZID DOI {action} failed for {item}: {ezid_result}'
+            if error_class:
+                msg = f'{msg} ({error_class} error)'
             logger.error(msg)
             if request:
                 messages.error(request, msg)
@@ -180,29 +276,41 @@ def get_preprint_metadata(preprint):
 
     return ezid_metadata
 
-def preprint_doi(preprint, action, request):
-    if RepoEZIDSettings.objects.filter(repo=preprint.repository).exists():
-        ezid_metadata = get_preprint_metadata(preprint)
-        ezid_settings = RepoEZIDSettings.objects.get(repo=preprint.repository)
-
-        shoulder = ezid_settings.ezid_shoulder
-        username = ezid_settings.ezid_username
-        password  = ezid_settings.ezid_password
-        endpoint_url = ezid_settings.ezid_endpoint_url
-        owner = ezid_settings.ezid_owner
-
-        payload = prepare_payload(
-            ezid_metadata,
-            'ezid/posted_content.xml',
-            ezid_metadata['target_url'], owner
+def get_repo_settings(repository):
+    ''' the EZID settings of a repository, None if EZID is not enabled for it '''
+    return RepoEZIDSettings.objects.filter(repo=repository).first()
+
+def build_preprint_request(preprint, action, ezid_settings, now=None):
+    ''' the EZID request for a preprint, built without sending it '''
+    ezid_metadata = get_preprint_metadata(preprint)
+    if now is not None:
+        ezid_metadata['now'] = now
+    payload = prepare_payload(
+        ezid_metadata,
+        'ezid/posted_content.xml',
+        ezid_metadata['target_url'], ezid_settings.ezid_owner
+    )
+
+    if action == "update":
+        path = f'id/doi:{encode(preprint.preprint_doi)}'
+    else:
+        path = f'shoulder/{encode(ezid_settings.ezid_shoulder)}'
+    return EzidRequest("POST", path, payload, preprint.preprint_doi)
+
+def preprint_doi(preprint, action, request, ezid_settings=None):
+    ''' bulk callers resolve the repository settings once and pass them in '''
+    if ezid_settings is None:
+        ezid_settings = get_repo_settings(preprint.repository)
+    if ezid_settings is not None:
+        ezid_request = build_preprint_request(preprint, action, ezid_settings)
+        ezid_result = send_request(
+            ezid_request.method,
+            ezid_request.path,
+            ezid_request.payload,
+            ezid_settings.ezid_username,
+            ezid_settings.ezid_password,
+            ezid_settings.ezid_endpoint_url,
         )
-
-        if action == "update":
-            path = f'id/doi:{encode(preprint.preprint_doi)}'
-        else:
-            path = f'shoulder/{encode(shoulder)}'
-
-        ezid_result = send_request("POST", path, payload, username, password, endpoint_url)
         doi = process_ezid_result(preprint, action, ezid_result, request)
         if doi:
             preprint.preprint_doi = doi
@@ -210,31 +318,150 @@ def preprint_doi(preprint, action, request):
         return True, (doi is not None), ezid_result
     return False, False, f"EZID not enabled for {preprint.repository}"
 
-def update_preprint_doi(preprint, request=None):
+def update_preprint_doi(preprint, request=None, ezid_settings=None):
     if not preprint.preprint_doi:
         msg = f'{preprint} does not have a DOI'
         logger.info(msg)
         return True, False, msg
-    return preprint_doi(preprint, "update", request)
+    return preprint_doi(preprint, "update", request, ezid_settings=ezid_settings)
 
-def mint_preprint_doi(preprint, request=None):
+def mint_preprint_doi(preprint, request=None, ezid_settings=None):
     if preprint.preprint_doi:
         msg = f'{preprint} already has a DOI: {preprint.preprint_doi}'
         logger.info(msg)
         return True, False, msg
-    return preprint_doi(preprint, "mint", request)
+    return preprint_doi(preprint, "mint", request, ezid_settings=ezid_settings)
+
+def queue_doi_request(action, preprint):
+    ''' writes an outbox entry, a worker sends it to EZID once the transaction commits '''
+    entry = EzidOutbox.objects.create(action=action, preprint=preprint)
+    transaction.on_commit(lambda: async_task(OUTBOX_TASK, entry.id))
+    return entry
 
 def preprint_publication(**kwargs):
     ''' hook script for the preprint_publication event '''
-    logger.debug('>>> preprint_publication called, mint an EZID DOI...')
+    logger.debug('>>> preprint_publication called, queue an EZID DOI mint...')
     preprint = kwargs.get('preprint')
     request = kwargs.get('request')
-    _enabled, _success, _msg = mint_preprint_doi(preprint, request=request)
+    if preprint.preprint_doi:
+        logger.info(f'{preprint} already has a DOI: {preprint.preprint_doi}')
+        return
+    if not RepoEZIDSettings.objects.filter(repo=preprint.repository).exists():
+        logger.debug(f"EZID not enabled for {preprint.repository}")
+        return
+    queue_doi_request(EzidOutbox.MINT, preprint=preprint)
+    if request:
+        messages.info(request, f'EZID DOI mint queued for {preprint}')
 
 def get_setting(prefix, name, journal):
     return setting_handler.get_setting(prefix, name, journal).processed_value
 
-def get_journal_metadata(article):
+@dataclass(frozen=True)
+class JournalEzidConfig: # pylint: disable=too-many-instance-attributes
+    """EZID and crossref settings for one journal, resolved in one go"""
+    enabled: bool
+    username: str = None
+    password: str = None
+    endpoint_url: str = None
+    depositor_name: str = None
+    depositor_email: str = None
+    registrant: str = None
+    book_chapter: bool = False
+    issn: str = None
+
+    @property
+    def template(self):
+        return 'ezid/book_chapter.xml' if self.book_chapter else 'ezid/journal_content.xml'
+
+    @property
+    def is_configured(self):
+        return bool(self.username and self.password and self.endpoint_url and self.registrant)
+
+def get_journal_config(journal):
+    ''' the other settings are only looked up when EZID is enabled for the journal '''
+    enabled = get_setting('plugin:ezid', 'ezid_plugin_enable', journal)
+    if not enabled:
+        return JournalEzidConfig(enabled=enabled, issn=journal.issn)
+    return JournalEzidConfig(
+        enabled=enabled,
+        username=get_setting('plugin:ezid', 'ezid_plugin_username', journal),
+        password=get_setting('plugin:ezid', 'ezid_plugin_password', journal),
+        endpoint_url=get_setting('plugin:ezid', 'ezid_plugin_endpoint_url', journal),
+        depositor_name=get_setting('Identifiers', 'crossref_name', journal),
+        depositor_email=get_setting('Identifiers', 'crossref_email', journal),
+        registrant=get_setting('Identifiers', 'crossref_registrant', journal),
+        book_chapter=get_setting('plugin:ezid', 'ezid_book_chapter', journal),
+        issn=journal.issn,
+    )
+
+class JournalConfigCache:
+    """Resolves each journal's EZID config once for the length of a job"""
+    def __init__(self):
+        self._configs = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, journal):
+        with self._lock:
+            config = self._configs.get(journal.pk)
+            if config is not None:
+                self.hits += 1
+                return config
+            self.misses += 1
+        config = get_journal_config(journal)
+        with self._lock:
+            return self._configs.setdefault(journal.pk, config)
+
+def load_articles(article_ids):
+    '''
+    fetches the articles with their journal, issue, license, frozen authors
+    and DOI identifiers in a fixed number of queries, in the order given
+    '''
+    articles = (
+        Article.objects.filter(pk__in=article_ids)
+        .select_related('journal', 'primary_issue', 'license')
+        .prefetch_related(
+            Prefetch('frozenauthor_set', to_attr='ezid_frozen_authors'),
+            Prefetch(
+                'identifier_set',
+                queryset=Identifier.objects.filter(id_type='doi'),
+                to_attr='ezid_doi_identifiers',
+            ),
+        )
+    )
+    by_pk = {article.pk: article for article in articles}
+    return [by_pk[pk] for pk in article_ids if pk in by_pk]
+
+def load_issue_articles(issue):
+    return load_articles([article.pk for article in issue.get_sorted_articles()])
+
+def get_article_doi(article):
+    ''' the article DOI, from the prefetched identifiers when loaded with load_articles '''
+    identifiers = getattr(article, 'ezid_doi_identifiers', None)
+    if identifiers is None:
+        return article.get_doi()
+    return identifiers[0].identifier if identifiers else None
+
+def get_frozen_authors(article):
+    authors = getattr(article, 'ezid_frozen_authors', None)
+    if authors is None:
+        authors = list(article.frozen_authors())
+    return authors
+
+def last_metadata_change(article):
+    '''
+    latest last_modified of the article and of the frozen authors, license
+    and issue its payload is built from, None if none of them record it
+    '''
+    sources = [article, *get_frozen_authors(article), article.license, article.primary_issue]
+    dates = [getattr(source, 'last_modified', None) for source in sources if source is not None]
+    dates = [date for date in dates if date]
+    return max(dates) if dates else None
+
+def get_journal_metadata(article, config=None):
+    if config is None:
+        config = get_journal_config(article.journal)
     download_url = None
     if article.remote_url:
         # get id from url and add prefix to prepare item id
@@ -244,56 +471,83 @@ def get_journal_metadata(article):
     return {'now': timezone.now(),
             'target_url': article.remote_url if article.remote_url else article.url,
             'article': article,
+            'authors': get_frozen_authors(article),
             'title': escape_str(article.title),
             'abstract': escape_str(article.abstract),
-            'doi': article.get_doi(),
-            'depositor_name': get_setting('Identifiers', 'crossref_name', article.journal),
-            'depositor_email': get_setting('Identifiers', 'crossref_email', article.journal),
-            'registrant': get_setting('Identifiers', 'crossref_registrant', article.journal),
+            'doi': get_article_doi(article),
+            'depositor_name': config.depositor_name,
+            'depositor_email': config.depositor_email,
+            'registrant': config.registrant,
             'download_url': download_url,
             'license_url': get_license_url(article)}
 
-def get_journal_template(journal):
-    is_book_chapter = get_setting('plugin:ezid', 'ezid_book_chapter', journal)
-    return 'ezid/book_chapter.xml' if is_book_chapter else 'ezid/journal_content.xml'
-
-def journal_article_doi(article, action, request):
-    if get_setting('plugin:ezid', 'ezid_plugin_enable', article.journal): # pylint: disable=no-else-return
-        if not is_valid_issn(article.journal.issn) and not is_valid_url(article.journal.issn):
-            msg = f"Invalid ISSN {article.journal.issn} for {article.journal}"
+def build_journal_request(article, action, config, now=None, timings=None):
+    '''
+    the EZID request for an article, built without sending it, returns the
+    request and None, or None and the reason it cannot be built, the time
+    spent on the metadata and the render is added to `timings`
+    '''
+    if not is_valid_issn(config.issn) and not is_valid_url(config.issn):
+        return None, f"Invalid ISSN {config.issn} for {article.journal}"
+
+    started = time.perf_counter()
+    ezid_metadata = get_journal_metadata(article, config)
+    add_timing(timings, 'metadata', started)
+    if now is not None:
+        ezid_metadata['now'] = now
+    if not ezid_metadata["doi"] and action != "mint":
+        return None, f"{article} not assigned a DOI"
+
+    if action == "update":
+        ezid_metadata['update_id'] = ezid_metadata["doi"]
+
+    if not config.is_configured:
+        return None, f"EZID not fully configured for {article.journal}"
+
+    started = time.perf_counter()
+    path = f'id/doi:{encode(ezid_metadata["doi"])}'
+    payload = prepare_payload(
+        ezid_metadata, config.template, ezid_metadata["target_url"], config.registrant)
+    add_timing(timings, 'render', started)
+    # use PUT to create and update with update_if_exisits flag
+    return EzidRequest("PUT", path, payload, ezid_metadata["doi"]), None
+
+def journal_article_doi(article, action, request, skip_unchanged=False, config=None, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                        timings=None, fingerprints=None):
+    '''
+    with a `timings` dict, the seconds spent on the metadata (settings
+    included), the payload render and the EZID round trip are added to it,
+    with `fingerprints` the payload fingerprints are read from and kept in it
+    '''
+    if config is None:
+        started = time.perf_counter()
+        config = get_journal_config(article.journal)
+        add_timing(timings, 'metadata', started)
+    if config.enabled: # pylint: disable=no-else-return
+        ezid_request, msg = build_journal_request(article, action, config, timings=timings)
+        if ezid_request is None:
             if request:
                 messages.error(request, msg)
             return True, False, msg
 
-        ezid_metadata = get_journal_metadata(article)
-        if not ezid_metadata["doi"] and action != "mint":
-            msg = f"{article} not assigned a DOI"
-            if request:
-                messages.error(request, msg)
-            return True, False, msg
-        template = get_journal_template(article.journal)
-
-        if action == "update":
-            ezid_metadata['update_id'] = ezid_metadata["doi"]
-
-        # use PUT to create and update with update_if_exisits flag
-        method = "PUT"
-
-        username = get_setting('plugin:ezid', 'ezid_plugin_username', article.journal)
-        password = get_setting('plugin:ezid', 'ezid_plugin_password', article.journal)
-        endpoint_url = get_setting('plugin:ezid', 'ezid_plugin_endpoint_url', article.journal)
-        owner = get_setting('Identifiers', 'crossref_registrant', article.journal)
-
-        if not username or not password or not endpoint_url or not owner:
-            msg = f"EZID not fully configured for {article.journal}"
-            if request:
-                messages.error(request, msg)
-            return True, False, msg
-
-        path = f'id/doi:{encode(ezid_metadata["doi"])}'
-        payload = prepare_payload(ezid_metadata, template, ezid_metadata["target_url"], owner)
-        ezid_result = send_request(method, path, payload, username, password, endpoint_url)
+        fingerprint = payload_fingerprint(ezid_request.payload)
+        if skip_unchanged and is_payload_unchanged(ezid_request.doi, fingerprint, fingerprints):
+            logger.debug(f"Skipping {article}, payload unchanged for {ezid_request.doi}")
+            return True, True, UNCHANGED
+
+        started = time.perf_counter()
+        ezid_result = send_request(
+            ezid_request.method,
+            ezid_request.path,
+            ezid_request.payload,
+            config.username,
+            config.password,
+            config.endpoint_url,
+        )
+        add_timing(timings, 'http', started)
         doi = process_ezid_result(article, action, ezid_result, request)
+        if doi:
+            save_payload_fingerprint(ezid_request.doi, fingerprint, fingerprints)
         return True, (doi is not None), ezid_result
     else:
         msg = f"EZID not enabled for {article.journal}"
@@ -301,14 +555,17 @@ def journal_article_doi(article, action, request):
             messages.warning(request, msg)
         return False, False, msg
 
-def update_journal_doi(article, request=None):
-    return journal_article_doi(article, "update", request)
+def update_journal_doi(article, request=None, skip_unchanged=False, config=None, timings=None, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                       fingerprints=None):
+    return journal_article_doi(article, "update", request,
+                               skip_unchanged=skip_unchanged, config=config, timings=timings,
+                               fingerprints=fingerprints)
 
-def register_journal_doi(article, request=None):
-    return journal_article_doi(article, "register", request)
+def register_journal_doi(article, request=None, config=None):
+    return journal_article_doi(article, "register", request, config=config)
 
 def assign_article_doi(**kwargs):
     article = kwargs.get('article')
-    if get_setting('plugin:ezid', 'ezid_plugin_enable', article.journal):
+    if get_journal_config(article.journal).enabled:
         if not article.get_doi():
             _id = id_logic.generate_crossref_doi_with_pattern(article)
@@ -0,0 +1,60 @@
+"""
+Janeway Management command that benchmarks the journal DOI deposit pipeline
+on synthetic data against the local EZID stand-in
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from plugins.ezid.benchmark import run_benchmark
+
+class Command(BaseCommand):
+    """Times each stage of a DOI deposit on generated articles and writes the results as JSON"""
+    help = ("Generates synthetic journals, issues and articles in a rolled back transaction "
+            "and times each stage of a DOI deposit on them against a local EZID stand-in. "
+            "The results are written as JSON so runs on different commits can be compared.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--journals", type=int, default=1)
+        parser.add_argument("--issues", type=int, default=2, help="issues per journal")
+        parser.add_argument("--articles", type=int, default=50, help="articles per issue")
+        parser.add_argument("--abstract-words", type=int, default=200,
+                            help="mean abstract length in words (default 200)")
+        parser.add_argument("--max-authors", type=int, default=60,
+                            help="cap on the authors of an article (default 60)")
+        parser.add_argument("--latency", type=float, default=0.005,
+                            help="seconds the EZID stand-in takes to answer (default 0.005)")
+        parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="share of requests the stand-in fails with a 500")
+        parser.add_argument("--seed", type=int, default=1,
+                            help="seed of the generated data, the same seed gives the same data")
+        parser.add_argument("--no-memory", action="store_true",
+                            help="do not trace memory, tracing slows every stage down")
+        parser.add_argument("--output", default="ezid_benchmark.json",
+                            help="JSON file the results are written to")
+
+    def handle(self, *args, **options):
+        results = run_benchmark(
+            journals=options['journals'],
+            issues=options['issues'],
+            articles=options['articles'],
+            abstract_words=options['abstract_words'],
+            max_authors=options['max_authors'],
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+            trace_memory=not options['no_memory'],
+        )
+        with open(options['output'], "w", encoding="UTF-8") as output:
+            json.dump(results, output, indent=2)
+
+        self.stdout.write(f"{'stage':<22}{'items':>7}{'seconds':>10}{'p50 ms':>10}"
+                          f"{'p95 ms':>10}{'queries':>9}{'peak KiB':>11}")
+        for stage in results['stages']:
+            self.stdout.write(
+                f"{stage['stage']:<22}{stage['items']:>7}{stage['seconds']:>10.3f}"
+                f"{stage.get('p50_ms', ''):>10}{stage.get('p95_ms', ''):>10}"
+                f"{stage['queries']:>9}{stage.get('peak_memory_kib', ''):>11}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
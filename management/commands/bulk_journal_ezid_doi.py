@@ -0,0 +1,147 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from plugins.ezid import logic
+from plugins.ezid.bulk import (
+    DONE,
+    ResultsLog,
+    collect_article_ids,
+    error_result,
+    read_results,
+    result,
+    run_in_workers,
+)
+
+KEY = 'article_id'
+
+class Command(BaseCommand):
+    """Registers or updates the EZID DOIs of many journal articles in one run"""
+    help = ("Registers or updates the EZID DOIs of many journal articles. Article ids "
+            "come from the arguments, --file (- for stdin), --journal or --issue.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["register", "update"])
+        parser.add_argument("article_ids", nargs="*", type=int,
+                            help="`id` of the articles")
+        parser.add_argument("--file", help="file with one article id per line, - for stdin")
+        parser.add_argument("--journal", help="code of a journal, all its published articles")
+        parser.add_argument("--issue", type=int, help="`id` of an issue, all its articles")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="articles sent to EZID in parallel (default 4)")
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="articles loaded from the database at a time (default 100)")
+        parser.add_argument("--results", default="ezid_bulk_results.jsonl",
+                            help="JSON lines file the outcome of each article is appended to")
+        parser.add_argument("--skip-unchanged", action="store_true",
+                            help="do not send updates whose payload matches the last deposit")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="load the articles and report what would be sent")
+        parser.add_argument("--resume", action="store_true",
+                            help="skip the articles the results file records as done")
+        parser.add_argument("--only-failed", action="store_true",
+                            help="only the articles the results file records as failed")
+
+    def collect_ids(self, options):
+        return collect_article_ids(
+            options['article_ids'],
+            id_file=options['file'],
+            journal_code=options['journal'],
+            issue_id=options['issue'],
+        )
+
+    def select_ids(self, ids, options):
+        if not (options['resume'] or options['only_failed']):
+            return ids
+        statuses = read_results(options['results'])
+        if options['only_failed']:
+            failed = [pk for pk, status in statuses.items() if status == 'failure']
+            # without ids to choose from, every failed article in the file
+            return [pk for pk in ids if statuses.get(pk) == 'failure'] if ids else failed
+        return [pk for pk in ids if statuses.get(pk) not in DONE]
+
+    def process(self, article, options, config_cache):
+        started = time.monotonic()
+        action = options['action']
+        config = config_cache.get(article.journal)
+        doi = logic.get_article_doi(article)
+        attempts = None
+        try:
+            if options['dry_run']:
+                status = 'dry-run'
+                if config.enabled:
+                    message = f"Would {action} {doi or 'no DOI'} for {article}"
+                else:
+                    message = f"EZID not enabled for {article.journal}"
+            else:
+                if action == 'register':
+                    enabled, success, message = logic.register_journal_doi(article, config=config)
+                else:
+                    enabled, success, message = logic.update_journal_doi(
+                        article, skip_unchanged=options['skip_unchanged'], config=config,
+                    )
+                attempts = getattr(message, 'attempts', None)
+                if message == logic.UNCHANGED:
+                    status = 'unchanged'
+                elif success:
+                    status = 'success'
+                else:
+                    status = 'failure' if enabled else 'disabled'
+        except Exception as e: # pylint: disable=broad-exception-caught
+            return error_result(KEY, article.pk, action, e, doi=doi)
+        return result(
+            KEY, article.pk, action, status, message,
+            doi=doi,
+            attempts=attempts,
+            seconds=round(time.monotonic() - started, 3),
+        )
+
+    def process_chunk(self, chunk, options, config_cache, log):
+        articles = logic.load_articles(chunk)
+        found = {article.pk for article in articles}
+        for pk in chunk:
+            if pk not in found:
+                log.record(result(KEY, pk, options['action'], 'missing',
+                                  f"Article {pk} does not exist."))
+        for article in articles:
+            log.record(self.process(article, options, config_cache))
+
+    def handle(self, *args, **options):
+        ids = self.select_ids(self.collect_ids(options), options)
+        if not ids:
+            self.stdout.write(self.style.WARNING("No articles to process."))
+            return
+
+        workers = max(1, options['workers'])
+        batch_size = max(1, options['batch_size'])
+        # small enough chunks that every worker gets some
+        batch_size = min(batch_size, max(1, len(ids) // workers))
+        chunks = (ids[i:i + batch_size] for i in range(0, len(ids), batch_size))
+        self.stdout.write(
+            f"{'Checking' if options['dry_run'] else 'Sending'} {options['action']} "
+            f"requests for {len(ids)} articles with {workers} workers, "
+            f"results in {options['results']}"
+        )
+
+        config_cache = logic.JournalConfigCache()
+        log = ResultsLog(options['results'], len(ids), self.stdout)
+
+        def on_error(chunk, error):
+            for pk in chunk:
+                log.record(error_result(KEY, pk, options['action'], error))
+
+        try:
+            run_in_workers(
+                chunks,
+                lambda chunk: self.process_chunk(chunk, options, config_cache, log),
+                workers,
+                on_error,
+            )
+        finally:
+            log.close()
+
+        message = f"Processed {log.done} articles in {log.elapsed():.1f}s: {log.summary()}"
+        if log.counts['failure'] or log.counts['missing']:
+            self.stdout.write(self.style.ERROR(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
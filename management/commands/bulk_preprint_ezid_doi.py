@@ -0,0 +1,138 @@
+"""
+Janeway Management command for minting or updating the DOIs of all the
+published preprints of a repository
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+
+from plugins.ezid import logic
+from plugins.ezid.bulk import DONE, ResultsLog, error_result, read_results, result, run_in_workers
+from repository.models import Repository, Preprint, PreprintAuthor
+
+KEY = 'preprint_id'
+
+class Command(BaseCommand):
+    """Mints DOIs for the published preprints of a repository without one, or updates them all"""
+    help = ("Mints a DOI for every published preprint of the repository that has none, "
+            "or updates the metadata of every existing preprint DOI.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="`short_name` of the repository", type=str)
+        parser.add_argument("action", choices=["mint", "update"])
+        parser.add_argument("--workers", type=int, default=4,
+                            help="preprints sent to EZID in parallel (default 4)")
+        parser.add_argument("--chunk-size", type=int, default=100,
+                            help="preprints loaded from the database at a time (default 100)")
+        parser.add_argument("--results", default="ezid_preprint_results.jsonl",
+                            help="JSON lines file the outcome of each preprint is appended to")
+        parser.add_argument("--resume", action="store_true",
+                            help="skip the preprints the results file records as done")
+
+    def get_queryset(self, repo, action):
+        preprints = Preprint.objects.filter(repository=repo, date_published__lte=timezone.now())
+        no_doi = Q(preprint_doi__isnull=True) | Q(preprint_doi='')
+        if action == "mint":
+            return preprints.filter(no_doi)
+        return preprints.exclude(no_doi)
+
+    def chunks(self, queryset, size, skip):
+        ''' the preprints in pk order, one chunk in memory at a time '''
+        queryset = queryset.order_by('pk').select_related('repository', 'license').prefetch_related(
+            Prefetch(
+                'preprintauthor_set',
+                queryset=PreprintAuthor.objects.select_related('account'),
+            ),
+        )
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:size])
+            if not chunk:
+                return
+            last_pk = chunk[-1].pk
+            chunk = [preprint for preprint in chunk if preprint.pk not in skip]
+            if chunk:
+                yield chunk
+
+    def process(self, preprint, action, ezid_settings):
+        started = time.monotonic()
+        if not preprint.is_published():
+            return result(KEY, preprint.pk, action, 'skipped', f"{preprint} is not yet published")
+        try:
+            if action == "mint":
+                enabled, success, message = logic.mint_preprint_doi(
+                    preprint, ezid_settings=ezid_settings)
+            else:
+                enabled, success, message = logic.update_preprint_doi(
+                    preprint, ezid_settings=ezid_settings)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            return error_result(KEY, preprint.pk, action, e, doi=preprint.preprint_doi)
+        if success:
+            status = 'success'
+        else:
+            status = 'failure' if enabled else 'disabled'
+        return result(
+            KEY, preprint.pk, action, status, message,
+            doi=preprint.preprint_doi,
+            attempts=getattr(message, 'attempts', None),
+            seconds=round(time.monotonic() - started, 3),
+        )
+
+    def handle(self, *args, **options):
+        short_name = options['short_name']
+        action = options['action']
+        try:
+            repo = Repository.objects.get(short_name=short_name)
+        except Repository.DoesNotExist as e:
+            raise CommandError('No repository found.') from e
+
+        # resolved once, not once per preprint
+        ezid_settings = logic.get_repo_settings(repo)
+        if ezid_settings is None:
+            raise CommandError(f"EZID not enabled for {repo}")
+
+        queryset = self.get_queryset(repo, action)
+        skip = set()
+        if options['resume']:
+            statuses = read_results(options['results'], key=KEY)
+            skip = {pk for pk, status in statuses.items() if status in DONE}
+        total = queryset.exclude(pk__in=skip).count() if skip else queryset.count()
+        if not total:
+            self.stdout.write(self.style.WARNING("No preprints to process."))
+            return
+
+        workers = max(1, options['workers'])
+        self.stdout.write(
+            f"Sending {action} requests for {total} preprints of {repo} with {workers} "
+            f"workers, results in {options['results']}"
+        )
+        log = ResultsLog(options['results'], total, self.stdout, noun="preprints")
+
+        def process_chunk(chunk):
+            for preprint in chunk:
+                log.record(self.process(preprint, action, ezid_settings))
+
+        def on_error(chunk, error):
+            for preprint in chunk:
+                log.record(error_result(KEY, preprint.pk, action, error))
+
+        try:
+            run_in_workers(
+                self.chunks(queryset, max(1, options['chunk_size']), skip),
+                process_chunk,
+                workers,
+                on_error,
+            )
+        finally:
+            log.close()
+
+        message = (f"Processed {log.done} preprints of {repo} in {log.elapsed():.1f}s: "
+                   f"{log.summary()}")
+        if log.counts['failure']:
+            self.stdout.write(self.style.ERROR(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,269 @@
+"""
+Janeway Management command that writes the EZID payloads of journal articles
+or preprints to a JSON lines or tar file, for audit and pre-flight checks,
+without sending anything to EZID
+"""
+
+import io
+import itertools
+import json
+import multiprocessing
+import sys
+import tarfile
+
+from django.core.cache import close_caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from plugins.ezid import logic
+from plugins.ezid.bulk import collect_article_ids
+from repository.models import Repository, Preprint, PreprintAuthor
+
+ARTICLE = 'article'
+PREPRINT = 'preprint'
+
+# chunks handed to the pool per worker process, rendered or being rendered
+CHUNKS_PER_PROCESS = 2
+
+# per process, each worker resolves the settings it needs once
+_journal_configs = logic.JournalConfigCache()
+_repo_settings = {}
+
+def payload_record(kind, pk, action, ezid_request=None, error=None):
+    ''' one exported payload, or the reason there is none '''
+    return {
+        'type': kind,
+        'id': pk,
+        'action': action,
+        'doi': ezid_request.doi if ezid_request else None,
+        'method': ezid_request.method if ezid_request else None,
+        'path': ezid_request.path if ezid_request else None,
+        'payload': ezid_request.payload if ezid_request else None,
+        'error': error,
+    }
+
+def render_articles(ids, action, now):
+    found = set()
+    records = []
+    for article in logic.load_articles(ids):
+        found.add(article.pk)
+        config = _journal_configs.get(article.journal)
+        if not config.enabled:
+            # the other settings are not resolved for a disabled journal
+            error = f"EZID not enabled for {article.journal}"
+            records.append(payload_record(ARTICLE, article.pk, action, error=error))
+            continue
+        try:
+            ezid_request, error = logic.build_journal_request(article, action, config, now=now)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            ezid_request, error = None, f"{e.__class__.__name__}: {e}"
+        records.append(payload_record(ARTICLE, article.pk, action, ezid_request, error))
+    for pk in ids:
+        if pk not in found:
+            records.append(payload_record(ARTICLE, pk, action, error=f"Article {pk} does not exist."))
+    return records
+
+def render_preprints(ids, now):
+    preprints = (
+        Preprint.objects.filter(pk__in=ids).order_by('pk')
+        .select_related('repository', 'license')
+        .prefetch_related(
+            Prefetch('preprintauthor_set', queryset=PreprintAuthor.objects.select_related('account')),
+        )
+    )
+    records = []
+    for preprint in preprints:
+        action = "update" if preprint.preprint_doi else "mint"
+        repo_id = preprint.repository_id
+        if repo_id not in _repo_settings:
+            _repo_settings[repo_id] = logic.get_repo_settings(preprint.repository)
+        ezid_settings = _repo_settings[repo_id]
+        if ezid_settings is None:
+            error = f"EZID not enabled for {preprint.repository}"
+            records.append(payload_record(PREPRINT, preprint.pk, action, error=error))
+            continue
+        try:
+            ezid_request = logic.build_preprint_request(preprint, action, ezid_settings, now=now)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            error = f"{e.__class__.__name__}: {e}"
+            records.append(payload_record(PREPRINT, preprint.pk, action, error=error))
+            continue
+        records.append(payload_record(PREPRINT, preprint.pk, action, ezid_request))
+    return records
+
+def render_chunk(task):
+    ''' the payload records of one chunk of ids, run in the worker processes '''
+    kind, ids, action, now = task
+    if kind == PREPRINT:
+        return render_preprints(ids, now)
+    return render_articles(ids, action, now)
+
+
+class JsonLinesWriter:
+    """One JSON object per payload"""
+    def __init__(self, stream, owned):
+        self.stream = stream
+        self.owned = owned
+
+    def write(self, record):
+        self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class TarWriter:
+    """One member per payload, the request method and path in its PAX headers"""
+    def __init__(self, stream, owned, mode, now):
+        self.stream = stream
+        self.owned = owned
+        self.tar = tarfile.open(fileobj=stream, mode=mode, format=tarfile.PAX_FORMAT) # pylint: disable=consider-using-with
+        self.mtime = now.timestamp()
+
+    def write(self, record):
+        info = tarfile.TarInfo()
+        if record['error']:
+            info.name = f"{record['type']}/{record['id']}.error"
+            data = record['error'].encode("UTF-8")
+        else:
+            info.name = f"{record['type']}/{record['id']}.anvl"
+            info.pax_headers = {
+                'EZID.action': record['action'],
+                'EZID.method': record['method'],
+                'EZID.path': record['path'],
+            }
+            data = record['payload'].encode("UTF-8")
+        info.size = len(data)
+        info.mtime = self.mtime
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.tar.close()
+        if self.owned:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class Command(BaseCommand):
+    """Writes the EZID payloads of articles or preprints to a file without sending them"""
+    help = ("Renders the EZID payloads of journal articles (ids, --file, --journal, --issue) "
+            "or of the published preprints of a repository (--repository) to a JSON lines "
+            "or tar file. Nothing is sent to EZID.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("article_ids", nargs="*", type=int, help="`id` of the articles")
+        parser.add_argument("--file", help="file with one article id per line, - for stdin")
+        parser.add_argument("--journal", help="code of a journal, all its published articles")
+        parser.add_argument("--issue", type=int, help="`id` of an issue, all its articles")
+        parser.add_argument("--repository",
+                            help="`short_name` of a repository, all its published preprints")
+        parser.add_argument("--action", choices=["register", "update"], default="update",
+                            help="request rendered for the articles (default update)")
+        parser.add_argument("--format", choices=["jsonl", "tar"], default="jsonl")
+        parser.add_argument("--output", default="-",
+                            help="file written to, - for stdout, a .gz name compresses a tar")
+        parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                            help="processes rendering in parallel (default one per CPU)")
+        parser.add_argument("--chunk-size", type=int, default=100,
+                            help="items rendered by a process at a time (default 100)")
+        parser.add_argument("--now",
+                            help="ISO 8601 timestamp rendered in every payload, so two "
+                                 "exports can be diffed (default the current time)")
+
+    def collect(self, options):
+        if options['repository']:
+            if options['article_ids'] or options['file'] or options['journal'] or options['issue']:
+                raise CommandError("Export either articles or the preprints of a repository.")
+            try:
+                repo = Repository.objects.get(short_name=options['repository'])
+            except Repository.DoesNotExist as e:
+                raise CommandError('No repository found.') from e
+            ids = list(Preprint.objects.filter(
+                repository=repo, date_published__lte=timezone.now(),
+            ).order_by('pk').values_list('pk', flat=True))
+            return PREPRINT, ids
+        return ARTICLE, collect_article_ids(
+            options['article_ids'],
+            id_file=options['file'],
+            journal_code=options['journal'],
+            issue_id=options['issue'],
+        )
+
+    def get_now(self, value):
+        if not value:
+            return timezone.now()
+        now = parse_datetime(value)
+        if now is None:
+            raise CommandError(f"--now is not an ISO 8601 timestamp: {value}")
+        if timezone.is_naive(now):
+            now = timezone.make_aware(now)
+        return now
+
+    def rendered(self, tasks, processes):
+        ''' payload records in the order of the ids, rendered chunk by chunk '''
+        if processes <= 1:
+            for task in tasks:
+                yield from render_chunk(task)
+            return
+        # the forked processes must open their own connections
+        connections.close_all()
+        close_caches()
+        # imap reads the whole iterable ahead of the workers, the chunks are
+        # fed a few per process at a time so the rendered ones do not pile up
+        tasks = iter(tasks)
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            while batch := list(itertools.islice(tasks, processes * CHUNKS_PER_PROCESS)):
+                for records in pool.imap(render_chunk, batch, chunksize=1):
+                    yield from records
+
+    def open_writer(self, options, now):
+        output = options['output']
+        if options['format'] == 'jsonl':
+            if output == '-':
+                return JsonLinesWriter(sys.stdout, owned=False)
+            return JsonLinesWriter(open(output, "w", encoding="UTF-8"), owned=True) # pylint: disable=consider-using-with
+        mode = "w|gz" if output.endswith((".gz", ".tgz")) else "w|"
+        if output == '-':
+            return TarWriter(sys.stdout.buffer, False, mode, now)
+        return TarWriter(open(output, "wb"), True, mode, now) # pylint: disable=consider-using-with
+
+    def handle(self, *args, **options):
+        kind, ids = self.collect(options)
+        # progress goes to stderr when the payloads go to stdout
+        report = self.stderr if options['output'] == '-' else self.stdout
+        if not ids:
+            report.write(self.style.WARNING("Nothing to export."))
+            return
+
+        now = self.get_now(options['now'])
+        processes = max(1, options['processes'])
+        chunk_size = max(1, options['chunk_size'])
+        tasks = (
+            (kind, ids[i:i + chunk_size], options['action'], now)
+            for i in range(0, len(ids), chunk_size)
+        )
+
+        writer = self.open_writer(options, now)
+        exported = failed = 0
+        try:
+            for record in self.rendered(tasks, processes):
+                writer.write(record)
+                if record['error']:
+                    failed += 1
+                else:
+                    exported += 1
+        finally:
+            writer.close()
+
+        message = f"Exported {exported} {kind} payloads, {failed} could not be rendered"
+        if failed:
+            report.write(self.style.WARNING(message))
+        else:
+            report.write(self.style.SUCCESS(message))
@@ -0,0 +1,29 @@
+"""
+Janeway Management command that prints a snapshot of the EZID metrics
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from plugins.ezid import metrics
+
+class Command(BaseCommand):
+    """Prints the EZID metrics recorded by every process sharing the cache"""
+    help = ("Prints the EZID request counters, latency histograms, rate limiter waits and "
+            "queue depths in the Prometheus text format, or as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true",
+                            help="print the series as a JSON list")
+        parser.add_argument("--reset", action="store_true",
+                            help="clear the recorded counters after printing them")
+
+    def handle(self, *args, **options):
+        if options['json']:
+            series = metrics.snapshot() + metrics.collect()
+            self.stdout.write(json.dumps(series, indent=2))
+        else:
+            self.stdout.write(metrics.render(), ending="")
+        if options['reset']:
+            metrics.reset()
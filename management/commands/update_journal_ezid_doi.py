@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-from submission.models import Article
 from plugins.ezid import logic
 
 class Command(BaseCommand):
@@ -16,10 +15,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         article_id = options['article_id']
 
-        if not Article.objects.filter(pk=article_id).exists():
+        articles = logic.load_articles([article_id])
+        if not articles:
             raise CommandError(f"Article {article_id} does not exist.")
 
-        article = Article.objects.get(id=article_id)
+        article = articles[0]
         self.stdout.write(f"Attempting to update a DOI for Article {article}")
 
         enabled, success, msg = logic.update_journal_doi(article)
@@ -0,0 +1,254 @@
+"""
+Metrics for EZID deposits, shared through the Django cache.
+
+Counters, gauges and histograms are cache counters, so the web process
+and every Django-Q worker add to the same series and no metrics service
+is needed.  The queue depths are read from the database when the metrics
+are collected, and the requests in flight are summed from a key each
+process keeps alive with a TTL, so a killed worker's requests drop out.
+render() formats everything as Prometheus text.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from plugins.ezid.models import (
+    EzidOutbox,
+    IssueDoiRefreshHistory,
+    JournalDoiRefreshChunk,
+    JournalDoiRefreshJob,
+    TaskStatus,
+)
+from plugins.ezid.ratelimit import cache_lock
+
+PREFIX = "ezid:metrics:"
+INDEX_KEY = f"{PREFIX}index"
+IN_FLIGHT_INDEX_KEY = f"{PREFIX}in_flight:index"
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# cache counters are integers, seconds are kept in microseconds
+MICRO = 1_000_000
+
+METRICS = {
+    'ezid_requests_total': ('counter', "EZID requests by action and outcome"),
+    'ezid_request_attempts_total': ('counter', "HTTP requests sent to EZID, retries included"),
+    'ezid_request_duration_seconds': ('histogram', "Time to send an EZID request, retries included"),
+    'ezid_requests_in_flight': ('gauge', "EZID requests being sent"),
+    'ezid_rate_limit_waits_total': ('counter', "Requests held back by the rate limiter"),
+    'ezid_rate_limit_wait_seconds_total': ('counter', "Seconds requests were held back by the rate limiter"),
+    'ezid_throttled_responses_total': ('counter', "Responses where EZID asked us to slow down"),
+    'ezid_refresh_jobs': ('gauge', "Issue DOI refresh jobs waiting or running"),
+    'ezid_journal_refresh_jobs': ('gauge', "Journal DOI refresh jobs waiting or running"),
+    'ezid_journal_refresh_chunks': ('gauge', "Chunks of journal DOI refreshes waiting or running"),
+    'ezid_outbox_entries': ('gauge', "Queued DOI requests waiting or being sent"),
+}
+
+# series this process has added to the index already
+_known = set()
+_known_lock = threading.Lock()
+
+# the requests this process is sending, a forked worker starts from zero
+_in_flight = {'pid': None, 'count': 0}
+_in_flight_lock = threading.Lock()
+
+def enabled():
+    return getattr(settings, 'EZID_METRICS', True)
+
+def is_seconds(name):
+    return name.endswith(('_seconds_total', '_seconds_sum'))
+
+def series_key(name, labels):
+    identity = json.dumps([name, sorted(labels.items())])
+    return f"{PREFIX}{hashlib.sha1(identity.encode('UTF-8')).hexdigest()}"
+
+def _register(name, labels, force=False):
+    ''' the cache key of a series, added to the shared index the first time '''
+    key = series_key(name, labels)
+    with _known_lock:
+        if key in _known and not force:
+            return key
+    with cache_lock(INDEX_KEY):
+        index = cache.get(INDEX_KEY) or {}
+        if key not in index:
+            index[key] = (name, labels)
+            cache.set(INDEX_KEY, index, None)
+    with _known_lock:
+        _known.add(key)
+    return key
+
+def inc(name, amount=1, **labels):
+    ''' adds to a counter or a gauge '''
+    if not enabled():
+        return
+    if is_seconds(name):
+        amount *= MICRO
+    amount = int(round(amount))
+    key = _register(name, labels)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # a new series, or one the cache evicted along with the index
+        _register(name, labels, force=True)
+        if not cache.add(key, amount, None):
+            cache.incr(key, amount)
+
+def dec(name, amount=1, **labels):
+    inc(name, -amount, **labels)
+
+def observe(name, seconds, **labels):
+    ''' adds a duration to a histogram '''
+    if not enabled():
+        return
+    bound = next((str(bound) for bound in BUCKETS if seconds <= bound), "+Inf")
+    inc(f"{name}_bucket", le=bound, **labels)
+    inc(f"{name}_sum", seconds, **labels)
+    inc(f"{name}_count", **labels)
+
+def in_flight_ttl():
+    return getattr(settings, 'EZID_METRICS_IN_FLIGHT_TTL', 600)
+
+def _set_in_flight(key, count):
+    ''' writes the count of this process, added to the in flight index when the key is new '''
+    if cache.add(key, count, in_flight_ttl()):
+        with cache_lock(IN_FLIGHT_INDEX_KEY):
+            index = cache.get(IN_FLIGHT_INDEX_KEY) or set()
+            index.add(key)
+            cache.set(IN_FLIGHT_INDEX_KEY, index, None)
+    else:
+        cache.set(key, count, in_flight_ttl())
+
+def _track_in_flight(amount):
+    key = f"{PREFIX}in_flight:{socket.gethostname()}:{os.getpid()}"
+    with _in_flight_lock:
+        if _in_flight['pid'] != os.getpid():
+            _in_flight.update(pid=os.getpid(), count=0)
+        _in_flight['count'] = max(_in_flight['count'] + amount, 0)
+        _set_in_flight(key, _in_flight['count'])
+
+@contextmanager
+def in_flight():
+    ''' counts an EZID request as in flight while the block runs '''
+    if not enabled():
+        yield
+        return
+    _track_in_flight(1)
+    try:
+        yield
+    finally:
+        _track_in_flight(-1)
+
+def requests_in_flight():
+    ''' the sum of the live process counts, the expired keys are pruned from the index '''
+    index = cache.get(IN_FLIGHT_INDEX_KEY) or set()
+    counts = cache.get_many(list(index))
+    if len(counts) < len(index):
+        with cache_lock(IN_FLIGHT_INDEX_KEY):
+            index = cache.get(IN_FLIGHT_INDEX_KEY) or set()
+            counts = cache.get_many(list(index))
+            cache.set(IN_FLIGHT_INDEX_KEY, set(counts), None)
+    return sum(counts.values())
+
+def snapshot():
+    ''' every series recorded so far, [{'name', 'labels', 'value'}] '''
+    index = cache.get(INDEX_KEY) or {}
+    values = cache.get_many(list(index))
+    series = []
+    for key, (name, labels) in index.items():
+        value = values.get(key, 0)
+        if is_seconds(name):
+            value /= MICRO
+        series.append({'name': name, 'labels': labels, 'value': value})
+    return series
+
+def collect():
+    ''' the queue depths, read from the database, and the requests in flight '''
+    queues = {
+        'ezid_refresh_jobs': IssueDoiRefreshHistory,
+        'ezid_journal_refresh_jobs': JournalDoiRefreshJob,
+        'ezid_journal_refresh_chunks': JournalDoiRefreshChunk,
+        'ezid_outbox_entries': EzidOutbox,
+    }
+    series = [{'name': 'ezid_requests_in_flight', 'labels': {}, 'value': requests_in_flight()}]
+    for status in (TaskStatus.PENDING, TaskStatus.IN_PROGRESS):
+        label = TaskStatus(status).label.lower().replace(" ", "_")
+        for name, model in queues.items():
+            series.append({
+                'name': name,
+                'labels': {'status': label},
+                'value': model.objects.filter(status=status).count(),
+            })
+    return series
+
+def reset():
+    ''' forgets every recorded series '''
+    with cache_lock(INDEX_KEY):
+        index = cache.get(INDEX_KEY) or {}
+        cache.delete_many(list(index))
+        cache.delete(INDEX_KEY)
+    with _known_lock:
+        _known.clear()
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+    return f"{{{pairs}}}"
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _histogram_lines(name, series):
+    ''' cumulative buckets, sum and count of each label set of a histogram '''
+    groups = {}
+    for item in series:
+        labels = dict(item['labels'])
+        suffix = item['name'][len(name):]
+        le = labels.pop('le', None)
+        group = groups.setdefault(json.dumps(sorted(labels.items())), {
+            'labels': labels, 'buckets': {}, '_sum': 0, '_count': 0,
+        })
+        if suffix == '_bucket':
+            group['buckets'][le] = item['value']
+        else:
+            group[suffix] = item['value']
+    lines = []
+    for _identity, group in sorted(groups.items()):
+        total = 0
+        for bound in [str(bound) for bound in BUCKETS] + ["+Inf"]:
+            total += group['buckets'].get(bound, 0)
+            labels = {**group['labels'], 'le': bound}
+            lines.append(f"{name}_bucket{format_labels(labels)} {total}")
+        lines.append(f"{name}_sum{format_labels(group['labels'])} {format_value(group['_sum'])}")
+        lines.append(f"{name}_count{format_labels(group['labels'])} {group['_count']}")
+    return lines
+
+def render():
+    ''' every metric in the Prometheus text exposition format '''
+    series = snapshot() + collect()
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        if kind == 'histogram':
+            own = [item for item in series if item['name'] in (
+                f"{name}_bucket", f"{name}_sum", f"{name}_count")]
+        else:
+            own = [item for item in series if item['name'] == name]
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            lines.extend(_histogram_lines(name, own))
+        else:
+            for item in sorted(own, key=lambda item: sorted(item['labels'].items())):
+                lines.append(f"{name}{format_labels(item['labels'])} {format_value(item['value'])}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.22 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0004_rename_issue_pub_articledoirefreshhistory_issue_hist_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoiPayloadFingerprint',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('doi', models.CharField(max_length=255, unique=True)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('date_sent', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'DOI Payload Fingerprint',
+                'verbose_name_plural': 'DOI Payload Fingerprints',
+            },
+        ),
+        migrations.AlterField(
+            model_name='articledoirefreshhistory',
+            name='status',
+            field=models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged')], default=1),
+        ),
+        migrations.AlterField(
+            model_name='issuedoirefreshhistory',
+            name='status',
+            field=models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged')], default=1),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.22 on 2026-10-18 11:20
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count
+
+# TaskStatus values and the counter each one is added to
+STATUS_COUNTERS = {3: 'succeeded', 4: 'failed', 5: 'aborted', 6: 'unchanged'}
+COUNTER_FIELDS = ['total_articles', 'processed', *STATUS_COUNTERS.values()]
+
+
+def backfill_counters(apps, schema_editor):
+    IssueDoiRefreshHistory = apps.get_model('ezid', 'IssueDoiRefreshHistory')
+    ArticleDoiRefreshHistory = apps.get_model('ezid', 'ArticleDoiRefreshHistory')
+
+    counts = defaultdict(dict)
+    rows = (
+        ArticleDoiRefreshHistory.objects
+        .filter(issue_hist__isnull=False)
+        .order_by()
+        .values('issue_hist', 'status')
+        .annotate(n=Count('id'))
+    )
+    for row in rows:
+        counts[row['issue_hist']][row['status']] = row['n']
+
+    for issueh in IssueDoiRefreshHistory.objects.filter(pk__in=counts.keys()):
+        by_status = counts[issueh.pk]
+        for status, field in STATUS_COUNTERS.items():
+            setattr(issueh, field, by_status.get(status, 0))
+        issueh.processed = sum(by_status.get(status, 0) for status in STATUS_COUNTERS)
+        issueh.total_articles = sum(by_status.values())
+        issueh.save(update_fields=COUNTER_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0005_doipayloadfingerprint_unchanged_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='total_articles',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='processed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='succeeded',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='failed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='aborted',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='unchanged',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
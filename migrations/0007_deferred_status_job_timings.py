@@ -0,0 +1,38 @@
+# Generated by Django 4.2.22 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0006_issuedoirefreshhistory_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='deferred',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='network_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='local_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='articledoirefreshhistory',
+            name='status',
+            field=models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged'), (7, 'Deferred')], default=1),
+        ),
+        migrations.AlterField(
+            model_name='issuedoirefreshhistory',
+            name='status',
+            field=models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged'), (7, 'Deferred')], default=1),
+        ),
+    ]
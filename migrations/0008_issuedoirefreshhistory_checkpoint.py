@@ -0,0 +1,23 @@
+# Generated by Django 4.2.22 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0007_deferred_status_job_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='date_heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
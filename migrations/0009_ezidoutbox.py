@@ -0,0 +1,38 @@
+# Generated by Django 4.2.22 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repository', '0030_merge_20220613_1628'),
+        ('submission', '0082_article_abstract_es_article_title_es_section_name_es_and_more'),
+        ('ezid', '0008_issuedoirefreshhistory_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EzidOutbox',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('action', models.CharField(choices=[('mint', 'Mint preprint DOI'), ('register', 'Register article DOI'), ('update', 'Update article DOI')], max_length=20)),
+                ('status', models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged'), (7, 'Deferred')], default=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_attempted', models.DateTimeField(blank=True, null=True)),
+                ('date_completed', models.DateTimeField(blank=True, null=True)),
+                ('next_attempt', models.DateTimeField(blank=True, null=True)),
+                ('article', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='submission.article')),
+                ('preprint', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='repository.preprint')),
+            ],
+            options={
+                'verbose_name': 'EZID Outbox Entry',
+                'verbose_name_plural': 'EZID Outbox',
+                'ordering': ['-date_created'],
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='ezid_outbox_status_idx')],
+            },
+        ),
+    ]
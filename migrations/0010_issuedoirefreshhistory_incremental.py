@@ -0,0 +1,18 @@
+# Generated by Django 4.2.22 on 2026-10-18 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0009_ezidoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.22 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0010_issuedoirefreshhistory_incremental'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articledoirefreshhistory',
+            name='http_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='articledoirefreshhistory',
+            name='metadata_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='articledoirefreshhistory',
+            name='render_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='timings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.22 on 2026-10-18 18:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journal', '0067_issue_cached_display_title_es_and_more'),
+        ('ezid', '0011_refresh_stage_timings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JournalDoiRefreshJob',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('date_refresh', models.DateTimeField(auto_now_add=True)),
+                ('date_completed', models.DateTimeField(blank=True, null=True)),
+                ('date_queued', models.DateTimeField(blank=True, null=True)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('status', models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged'), (7, 'Deferred')], default=1)),
+                ('incremental', models.BooleanField(default=False)),
+                ('total_chunks', models.PositiveIntegerField(default=0)),
+                ('completed_chunks', models.PositiveIntegerField(default=0)),
+                ('failed_chunks', models.PositiveIntegerField(default=0)),
+                ('total_issues', models.PositiveIntegerField(default=0)),
+                ('total_articles', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('aborted', models.PositiveIntegerField(default=0)),
+                ('unchanged', models.PositiveIntegerField(default=0)),
+                ('deferred', models.PositiveIntegerField(default=0)),
+                ('journal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='journal.journal')),
+            ],
+            options={
+                'verbose_name': 'Journal DOI Refresh Job',
+                'verbose_name_plural': 'Journal DOI Refresh Jobs',
+                'ordering': ['-date_refresh'],
+            },
+        ),
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='journal_job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='issue_histories', to='ezid.journaldoirefreshjob'),
+        ),
+        migrations.CreateModel(
+            name='JournalDoiRefreshChunk',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('article_ids', models.JSONField(default=list)),
+                ('status', models.IntegerField(choices=[(1, 'Pending'), (2, 'In Progress'), (3, 'Success'), (4, 'Failure'), (5, 'Aborted'), (6, 'Unchanged'), (7, 'Deferred')], default=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('date_queued', models.DateTimeField(blank=True, null=True)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_completed', models.DateTimeField(blank=True, null=True)),
+                ('issue_hist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ezid.issuedoirefreshhistory')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='ezid.journaldoirefreshjob')),
+            ],
+            options={
+                'verbose_name': 'Journal DOI Refresh Chunk',
+                'verbose_name_plural': 'Journal DOI Refresh Chunks',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.22 on 2026-10-19 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0012_journaldoirefreshjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.22 on 2026-10-19 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0013_issuedoirefreshhistory_failures'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuedoirefreshhistory',
+            name='halted',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.22 on 2026-10-19 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0014_issuedoirefreshhistory_halted'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='ezidoutbox',
+            name='article',
+        ),
+        migrations.AlterField(
+            model_name='ezidoutbox',
+            name='action',
+            field=models.CharField(choices=[('mint', 'Mint preprint DOI')], max_length=20),
+        ),
+    ]
@@ -25,6 +25,8 @@ class TaskStatus(models.IntegerChoices):
     SUCCESS = 3, "Success"
     FAILURE = 4, "Failure"
     ABORTED = 5, "Aborted"
+    UNCHANGED = 6, "Unchanged"
+    DEFERRED = 7, "Deferred"
 
 class IssueDoiRefreshHistory(models.Model):
     """Issue level history of bulk DOI update"""
@@ -40,31 +42,76 @@ class IssueDoiRefreshHistory(models.Model):
         default=TaskStatus.PENDING,
     )
 
+    # only refresh the articles modified since their last successful refresh
+    incremental = models.BooleanField(default=False)
+
+    # progress counters, kept up to date as article outcomes are written
+    total_articles = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    aborted = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    deferred = models.PositiveIntegerField(default=0)
+
+    # checkpointing, a running job updates the heartbeat as it writes outcomes
+    date_heartbeat = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    # seconds the job spent waiting on EZID and doing everything else
+    network_seconds = models.FloatField(default=0)
+    local_seconds = models.FloatField(default=0)
+
+    # p50/p95 in milliseconds of each article stage and of the history writes
+    timings = models.JSONField(default=dict, blank=True)
+
+    # article failures counted as they happen, shared by the chunks of a journal refresh
+    failures = models.PositiveIntegerField(default=0)
+    # the error that stopped one chunk and stops the others, such as rejected credentials
+    halted = models.TextField(null=True, blank=True)
+
+    # the journal refresh this issue refresh is part of, its chunks do the work
+    journal_job = models.ForeignKey('JournalDoiRefreshJob',
+                                    blank=True,
+                                    null=True,
+                                    related_name='issue_histories',
+                                    on_delete=models.CASCADE)
+
+    # the counter incremented for each article outcome
+    STATUS_COUNTERS = {
+        TaskStatus.SUCCESS: 'succeeded',
+        TaskStatus.FAILURE: 'failed',
+        TaskStatus.ABORTED: 'aborted',
+        TaskStatus.UNCHANGED: 'unchanged',
+        TaskStatus.DEFERRED: 'deferred',
+    }
+
     def is_complete(self):
         return self.status not in (TaskStatus.PENDING, TaskStatus.IN_PROGRESS)
 
+    def percent_complete(self):
+        if not self.total_articles:
+            return 100 if self.is_complete() else 0
+        return min(100, int(100 * self.processed / self.total_articles))
+
     def result_text(self):
         if self.is_complete():
-            if self.articledoirefreshhistory_set:
-                total_success = (
-                    self.articledoirefreshhistory_set
-                    .filter(status=TaskStatus.SUCCESS)
-                    .count()
-                )
-
-                total = (
-                    self.articledoirefreshhistory_set
-                    .all()
-                    .count()
-                )
-
-                return (
-                    f"Refreshed DOI for {total_success} of {total} articles"
-                )
+            if self.total_articles:
+                text = f"Refreshed DOI for {self.succeeded} of {self.total_articles} articles"
+                if self.unchanged:
+                    text += f", {self.unchanged} unchanged"
+                if self.deferred:
+                    text += f", {self.deferred} deferred"
+                return text
 
             return "No article processed"
 
-        return "DOI refresh in process"
+        return f"DOI refresh in process, {self.percent_complete()}% complete"
+
+    def timing_rows(self):
+        """The stage timings in display order"""
+        stages = ['metadata', 'render', 'http', 'history_write']
+        return [(stage, self.timings[stage]) for stage in stages if stage in (self.timings or {})]
 
     def __str__(self):
         return self.result_text()
@@ -91,6 +138,11 @@ class ArticleDoiRefreshHistory(models.Model):
                                   null=True,
                                   on_delete=models.CASCADE)
 
+    # milliseconds spent on the metadata, the payload render and the EZID round trip
+    metadata_ms = models.FloatField(null=True, blank=True)
+    render_ms = models.FloatField(null=True, blank=True)
+    http_ms = models.FloatField(null=True, blank=True)
+
     def __str__(self):
         success = self.get_status_display()
         s = f"{self.article} DOI refresh {success} on {self.date_refresh}"
@@ -102,3 +154,165 @@ class ArticleDoiRefreshHistory(models.Model):
         ordering = ['-date_refresh']
         verbose_name = "Article DOI Refresh History"
         verbose_name_plural = "Article DOI Refresh Histories"
+
+
+class JournalDoiRefreshJob(models.Model):
+    """
+    DOI refresh of every issue of a journal.  The articles are split into
+    chunks that the Django-Q workers refresh in parallel, and the last chunk
+    to finish sets the status of the job and of its issue histories.
+    """
+    id = models.BigAutoField(primary_key=True)
+    journal = models.ForeignKey('journal.Journal', on_delete=models.CASCADE)
+    date_refresh = models.DateTimeField(auto_now_add=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+    # when the planning task was last queued
+    date_queued = models.DateTimeField(null=True, blank=True)
+    result = models.TextField(null=True, blank=True)
+
+    status = models.IntegerField(
+        choices=TaskStatus.choices,
+        default=TaskStatus.PENDING,
+    )
+    incremental = models.BooleanField(default=False)
+
+    # fan-in, set by the planning task and counted up as chunks finish
+    total_chunks = models.PositiveIntegerField(default=0)
+    completed_chunks = models.PositiveIntegerField(default=0)
+    failed_chunks = models.PositiveIntegerField(default=0)
+
+    # the counters of the issue histories, summed when the job completes
+    total_issues = models.PositiveIntegerField(default=0)
+    total_articles = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    aborted = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    deferred = models.PositiveIntegerField(default=0)
+
+    COUNTERS = ['processed', 'succeeded', 'failed', 'aborted', 'unchanged', 'deferred']
+
+    def is_complete(self):
+        return self.status not in (TaskStatus.PENDING, TaskStatus.IN_PROGRESS)
+
+    def live_processed(self):
+        """Articles processed so far by every chunk"""
+        if self.is_complete():
+            return self.processed
+        return self.issue_histories.aggregate(
+            processed=models.Sum('processed'),
+        )['processed'] or 0
+
+    def percent_complete(self):
+        if not self.total_articles:
+            return 100 if self.is_complete() else 0
+        return min(100, int(100 * self.live_processed() / self.total_articles))
+
+    def result_text(self):
+        if self.is_complete():
+            text = (f"Refreshed DOI for {self.succeeded} of {self.total_articles} articles "
+                    f"in {self.total_issues} issues")
+            if self.unchanged:
+                text += f", {self.unchanged} unchanged"
+            if self.deferred:
+                text += f", {self.deferred} deferred"
+            if self.result:
+                text += f", {self.result}"
+            return text
+
+        if self.status == TaskStatus.PENDING:
+            return "Journal DOI refresh queued"
+        return (f"Journal DOI refresh in process, {self.percent_complete()}% complete, "
+                f"{self.completed_chunks} of {self.total_chunks} chunks done")
+
+    def __str__(self):
+        return f"{self.journal}: {self.result_text()}"
+
+    class Meta:
+        ordering = ['-date_refresh']
+        verbose_name = "Journal DOI Refresh Job"
+        verbose_name_plural = "Journal DOI Refresh Jobs"
+
+
+class JournalDoiRefreshChunk(models.Model):
+    """A fixed size slice of the articles of one issue in a journal refresh"""
+    id = models.BigAutoField(primary_key=True)
+    job = models.ForeignKey('JournalDoiRefreshJob',
+                            related_name='chunks',
+                            on_delete=models.CASCADE)
+    issue_hist = models.ForeignKey('IssueDoiRefreshHistory', on_delete=models.CASCADE)
+    article_ids = models.JSONField(default=list)
+
+    status = models.IntegerField(
+        choices=TaskStatus.choices,
+        default=TaskStatus.PENDING,
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    # when the chunk task was last queued and last started
+    date_queued = models.DateTimeField(null=True, blank=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return (f"{len(self.article_ids)} articles of issue history {self.issue_hist_id}: "
+                f"{self.get_status_display()}")
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = "Journal DOI Refresh Chunk"
+        verbose_name_plural = "Journal DOI Refresh Chunks"
+
+
+class DoiPayloadFingerprint(models.Model):
+    """Hash of the last payload EZID accepted for a DOI"""
+    id = models.BigAutoField(primary_key=True)
+    doi = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    date_sent = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.doi} last sent on {self.date_sent}"
+
+    class Meta:
+        verbose_name = "DOI Payload Fingerprint"
+        verbose_name_plural = "DOI Payload Fingerprints"
+
+
+class EzidOutbox(models.Model):
+    """
+    A DOI request queued by a hook, sent to EZID by a Django-Q worker
+    so the editor's request does not wait on EZID.  Only the preprint
+    publication hook queues requests, to mint the preprint's DOI.
+    """
+    MINT = "mint"
+    ACTIONS = [
+        (MINT, "Mint preprint DOI"),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    action = models.CharField(max_length=20, choices=ACTIONS)
+    preprint = models.ForeignKey('repository.Preprint', null=True, blank=True,
+                                 on_delete=models.CASCADE)
+
+    status = models.IntegerField(
+        choices=TaskStatus.choices,
+        default=TaskStatus.PENDING,
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    result = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_attempted = models.DateTimeField(null=True, blank=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+    next_attempt = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.get_action_display()} for {self.preprint}: {self.get_status_display()}"
+
+    class Meta:
+        ordering = ['-date_created']
+        verbose_name = "EZID Outbox Entry"
+        verbose_name_plural = "EZID Outbox"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='ezid_outbox_status_idx'),
+        ]
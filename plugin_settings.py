@@ -1,6 +1,8 @@
 ''' Settings for the EZID plugin for Janeway '''
 import os
 
+from django_q.models import Schedule
+
 from utils import models
 from utils.install import update_settings
 from utils.logger import get_logger
@@ -56,6 +58,26 @@ def install():
         file_path="plugins/ezid/install/settings.json"
     )
 
+    # requeue the issue refreshes interrupted by a worker restart
+    Schedule.objects.get_or_create(
+        func='plugins.ezid.tasks.requeue_stale_refreshes',
+        defaults={
+            'name': 'EZID requeue stale DOI refreshes',
+            'schedule_type': Schedule.MINUTES,
+            'minutes': 10,
+        }
+    )
+
+    # send the queued DOI requests that are due for another try
+    Schedule.objects.get_or_create(
+        func='plugins.ezid.tasks.drain_outbox',
+        defaults={
+            'name': 'EZID drain DOI request outbox',
+            'schedule_type': Schedule.MINUTES,
+            'minutes': 5,
+        }
+    )
+
 def hook_registry():
     ''' connect a hook with a method in this plugin's logic '''
     logger.debug('hook_registry called for ezid plugin')
@@ -0,0 +1,224 @@
+"""
+Rate limiting for EZID requests.
+
+Each EZID account gets a token bucket kept in the Django cache, so every
+Django-Q worker sharing the cache draws from the same bucket.  The refill
+rate halves whenever EZID throttles us and creeps back up to the configured
+rate as requests succeed.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+LOCK_TIMEOUT = 5
+STATE_TIMEOUT = 60 * 60
+MAX_RETRY_AFTER = 300
+
+
+def parse_retry_after(value):
+    ''' seconds to wait from a Retry-After header, None if absent or invalid '''
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+@contextmanager
+def cache_lock(key, timeout=LOCK_TIMEOUT):
+    '''
+    a short lived lock shared through the cache, holding a token of its
+    owner so a lock taken over after a timeout is never released by the
+    holder it was taken from
+    '''
+    lock_key = f"{key}:lock"
+    token = uuid.uuid4().hex
+    give_up = time.monotonic() + timeout
+    while not cache.add(lock_key, token, timeout):
+        if time.monotonic() > give_up:
+            # the holder died without releasing it
+            logger.warning(f"Taking over stale lock {lock_key}")
+            cache.set(lock_key, token, timeout)
+            break
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        # it may have expired and been taken by another process meanwhile
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+def fits_deadline(seconds, deadline):
+    ''' whether a wait of `seconds` ends before the job deadline, if there is one '''
+    remaining = deadline.remaining() if deadline is not None else None
+    return remaining is None or seconds < remaining
+
+class RateLimiter:
+    """Token bucket shared across processes through the Django cache"""
+
+    def __init__(self, name, rate=None, burst=None):
+        self.name = name
+        self.key = f"ezid:ratelimit:{hashlib.sha1(name.encode('UTF-8')).hexdigest()}"
+        if rate is None:
+            rate = getattr(settings, 'EZID_RATE_LIMIT', 10.0)
+        self.max_rate = float(rate or 0)
+        self.min_rate = min(self.max_rate, getattr(settings, 'EZID_RATE_LIMIT_MIN', 0.5))
+        if burst is None:
+            burst = getattr(settings, 'EZID_RATE_BURST', max(1, int(self.max_rate)))
+        self.burst = burst
+
+        # metrics for this process
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttled_responses = 0
+
+    @property
+    def enabled(self):
+        return self.max_rate > 0
+
+    def _load(self, now):
+        state = cache.get(self.key)
+        if state is None:
+            state = {
+                'tokens': float(self.burst),
+                'updated': now,
+                'rate': self.max_rate,
+                'blocked_until': 0.0,
+            }
+        return state
+
+    def _save(self, state):
+        cache.set(self.key, state, STATE_TIMEOUT)
+
+    def _take(self):
+        ''' takes a token, returns 0 or the seconds to wait before trying again '''
+        with cache_lock(self.key):
+            now = time.time()
+            state = self._load(now)
+            if state['blocked_until'] > now:
+                delay = state['blocked_until'] - now
+            else:
+                elapsed = max(0.0, now - state['updated'])
+                state['tokens'] = min(self.burst, state['tokens'] + elapsed * state['rate'])
+                state['updated'] = now
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    delay = 0.0
+                else:
+                    delay = (1 - state['tokens']) / state['rate']
+            self._save(state)
+        return delay
+
+    def acquire(self, deadline=None):
+        '''
+        blocks until a request may be sent, returns the seconds waited, or
+        None without taking a token once the wait would outlast `deadline`
+        '''
+        if not self.enabled:
+            return 0.0
+        waited = 0.0
+        delay = self._take()
+        while delay > 0:
+            if not fits_deadline(delay, deadline):
+                waited = None
+                break
+            time.sleep(delay)
+            waited += delay
+            delay = self._take()
+        if waited:
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += waited
+        return waited
+
+    def throttled(self, retry_after=None, deadline=None):
+        '''
+        EZID pushed back: halve the rate and hold requests off, returns False
+        if the pause EZID asked for would outlast `deadline`
+        '''
+        with self._lock:
+            self.throttled_responses += 1
+        if not self.enabled:
+            if not fits_deadline(retry_after or 0, deadline):
+                return False
+            if retry_after:
+                time.sleep(retry_after)
+            return True
+        with cache_lock(self.key):
+            now = time.time()
+            state = self._load(now)
+            state['rate'] = max(self.min_rate, state['rate'] / 2)
+            state['tokens'] = 0.0
+            state['updated'] = now
+            pause = retry_after if retry_after is not None else 1 / state['rate']
+            state['blocked_until'] = max(state['blocked_until'], now + pause)
+            self._save(state)
+        logger.warning(f"EZID throttled {self.name}, rate now {state['rate']:.2f}/s")
+        return fits_deadline(pause, deadline)
+
+    def succeeded(self):
+        ''' additive increase back towards the configured rate '''
+        if not self.enabled:
+            return
+        state = cache.get(self.key)
+        if state is None or state['rate'] >= self.max_rate:
+            return
+        with cache_lock(self.key):
+            state = self._load(time.time())
+            state['rate'] = min(self.max_rate, state['rate'] + self.max_rate / 10)
+            self._save(state)
+
+    def current_rate(self):
+        state = cache.get(self.key)
+        return state['rate'] if state else self.max_rate
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.current_rate(),
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'throttled_responses': self.throttled_responses,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(endpoint_url, username):
+    ''' returns the limiter for an EZID account '''
+    name = f"{endpoint_url}|{username}"
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = RateLimiter(name)
+            _limiters[name] = limiter
+    return limiter
+
+def rate_limiter_stats():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+def reset_rate_limiters():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+        _limiters.clear()
+    for limiter in limiters:
+        cache.delete(limiter.key)
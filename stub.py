@@ -0,0 +1,202 @@
+"""
+A stand-in for the EZID API listening on localhost.
+
+It answers the requests the plugin sends: PUT id/...?update_if_exists=yes
+to create or update a DOI, POST shoulder/... to mint one and POST id/...
+to update one, with ANVL bodies and Basic auth.  Latency, an error rate
+and throttling can be set, so the transport, its retries and concurrency
+can be tested and benchmarked without EZID.
+
+    with StubEzid(latency=0.05, error_rate=0.1) as ezid:
+        send_request("PUT", path, payload, ezid.username, ezid.password, ezid.url)
+"""
+
+import base64
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+_re_anvl_escape = re.compile(r"%([0-9A-Fa-f]{2})")
+
+def parse_anvl(text):
+    ''' the element names and values of an ANVL body, percent escapes decoded '''
+    metadata = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise ValueError(f"no colon in line: {line[:40]}")
+        metadata[_unescape(name.strip())] = _unescape(value.strip())
+    return metadata
+
+def _unescape(value):
+    return _re_anvl_escape.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+
+class StubEzid: # pylint: disable=too-many-instance-attributes
+    """An EZID stand-in served from a thread, see the module docstring"""
+
+    def __init__(self, username="username", password="password", latency=0.0, # pylint: disable=too-many-arguments
+                 jitter=0.0, error_rate=0.0, error_status=500, rate_limit=None,
+                 retry_after=1, seed=None):
+        self.username = username
+        self.password = password
+        # seconds added to every response, plus up to `jitter` more
+        self.latency = latency
+        self.jitter = jitter
+        # share of authorized requests answered with `error_status`
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # requests per second above which the stub answers 429
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        # DOI -> ANVL metadata of every identifier created
+        self.identifiers = {}
+        self.responses = Counter()
+        self.requests = 0
+        self._minted = 0
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._refilled = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), StubEzidHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _throttled(self):
+        ''' token bucket holding a second of requests '''
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        if self._tokens is None:
+            self._tokens, self._refilled = float(self.rate_limit), now
+        self._tokens = min(float(self.rate_limit),
+                           self._tokens + (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def _authorized(self, header):
+        if not header or not header.startswith("Basic "):
+            return False
+        try:
+            credentials = base64.b64decode(header[6:]).decode("UTF-8")
+        except ValueError:
+            return False
+        return credentials == f"{self.username}:{self.password}"
+
+    def handle(self, method, target, authorization, body):
+        ''' the status, text and extra headers of the answer to a request '''
+        with self._lock:
+            self.requests += 1
+            if not self._authorized(authorization):
+                return 401, "error: unauthorized", {}
+            if self._throttled():
+                return 429, "error: too many requests", {"Retry-After": str(self.retry_after)}
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.error_status, "error: internal server error", {}
+
+        parts = urlsplit(target)
+        path = unquote(parts.path).lstrip("/")
+        query = parse_qs(parts.query)
+        try:
+            metadata = parse_anvl(body.decode("UTF-8"))
+        except ValueError as e:
+            return 400, f"error: bad request - {e}", {}
+        if "_target" not in metadata:
+            return 400, "error: bad request - no _target", {}
+
+        if path.startswith("shoulder/doi:") and method == "POST":
+            return self._mint(path[len("shoulder/doi:"):], metadata)
+        if path.startswith("id/doi:") and method in ("PUT", "POST"):
+            doi = path[len("id/doi:"):].upper()
+            update_if_exists = query.get("update_if_exists") == ["yes"]
+            return self._set(doi, metadata, create=method == "PUT", update=(
+                method == "POST" or update_if_exists))
+        return 400, "error: bad request - unrecognized request", {}
+
+    def _mint(self, shoulder, metadata):
+        with self._lock:
+            self._minted += 1
+            doi = f"{shoulder}{self._minted}".upper()
+            self.identifiers[doi] = metadata
+        return 201, f"success: doi:{doi} | ark:/b{doi[3:].lower()}", {}
+
+    def _set(self, doi, metadata, create, update):
+        with self._lock:
+            exists = doi in self.identifiers
+            if exists and not update:
+                return 400, "error: bad request - identifier already exists", {}
+            if not exists and not create:
+                return 400, "error: bad request - no such identifier", {}
+            self.identifiers[doi] = metadata
+        if exists:
+            return 200, f"success: doi:{doi} | ark:/b{doi[3:].lower()}", {}
+        return 201, f"success: doi:{doi} | ark:/b{doi[3:].lower()}", {}
+
+
+class StubEzidHandler(BaseHTTPRequestHandler):
+    """Hands every request to the StubEzid of the server"""
+    protocol_version = "HTTP/1.1"
+
+    def _answer(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if stub.latency or stub.jitter:
+            time.sleep(stub.latency + stub.random.uniform(0, stub.jitter))
+        status, text, headers = stub.handle(
+            self.command, self.path, self.headers.get("Authorization"), body)
+        with stub._lock: # pylint: disable=protected-access
+            stub.responses[status] += 1
+        data = text.encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_PUT = _answer
+    do_POST = _answer
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logger.debug(f"EZID stub: {format % args}")
@@ -4,88 +4,985 @@ Tasks for refreshing DOIs via Django‑Q.
 This module defines asynchronous task functions used to update
 journal and article DOIs and record their refresh history.
 """
+import queue
+import threading
+import time
+from datetime import timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, F, Max, OuterRef, Q, Sum
+from django.db.models.functions import Coalesce
+from django_q.tasks import async_task
 from django.utils import timezone
+from journal.models import Issue, Journal
 from utils.logger import get_logger
 from .models import (
     IssueDoiRefreshHistory,
     ArticleDoiRefreshHistory,
+    EzidOutbox,
+    JournalDoiRefreshChunk,
+    JournalDoiRefreshJob,
     TaskStatus,
 )
-from .logic import update_journal_doi
+from .logic import (
+    OUTBOX_TASK,
+    get_article_doi,
+    last_metadata_change,
+    mint_preprint_doi,
+    update_journal_doi,
+    load_articles,
+    load_issue_articles,
+    JournalConfigCache,
+    PayloadFingerprints,
+    UNCHANGED,
+)
+from .transport import AUTH, EXPIRED, THROTTLED, TRANSIENT, UNAVAILABLE, UNKNOWN, Deadline
 
 logger = get_logger(__name__)
 
+# a refresh job stops once more than this many articles have failed
+MAX_FAILURES = 3
+
+# errors every later article would hit too, the job stops at the first one
+HALTING_ERRORS = {
+    UNAVAILABLE: "EZID is unavailable",
+    AUTH: "EZID rejected the credentials",
+}
+
+# article stages timed by refresh_article_doi, and the history row field of each
+TIMED_STAGES = {
+    'metadata': 'metadata_ms',
+    'render': 'render_ms',
+    'http': 'http_ms',
+}
+
+def percentile(samples, fraction):
+    """The sample at `fraction` of the sorted samples, None without any"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def timing_summary(samples):
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.5), 3),
+        'p95_ms': round(percentile(samples, 0.95), 3),
+        'total_ms': round(sum(samples), 3),
+    }
+
+def stage_timings(rows):
+    """p50/p95 of each article stage over the history rows that recorded it"""
+    summary = {}
+    for stage, field in TIMED_STAGES.items():
+        samples = [getattr(row, field) for row in rows]
+        samples = [sample for sample in samples if sample is not None]
+        if samples:
+            summary[stage] = timing_summary(samples)
+    return summary
+
+class FailureBudget:
+    """Failure count shared by every worker of one refresh job"""
+    def __init__(self, max_failures=MAX_FAILURES):
+        self.max_failures = max_failures
+        self.failures = 0
+        self.halted = None
+        self._lock = threading.Lock()
+
+    @property
+    def exhausted(self):
+        return self.halted is not None or self.failures > self.max_failures
+
+    def halt(self, reason, shared=False): # pylint: disable=unused-argument
+        """
+        Stops the job regardless of the failure count, with `shared` the
+        other jobs sharing the budget stop too
+        """
+        with self._lock:
+            if self.halted is None:
+                self.halted = reason
+
+    @property
+    def reason(self):
+        return self.halted or "too many articles failed"
+
+    def record(self, success):
+        """Counts one article outcome, returns True once the job should stop"""
+        with self._lock:
+            self.failures += int(not success)
+            return self.exhausted
+
+    def sync(self):
+        """Called by the history writer at every flush, the budget is not shared"""
+
+class IssueFailureBudget(FailureBudget):
+    """
+    Failure count of one issue history, kept on the history row so the
+    chunks refreshing the issue on other workers share it.  Failures are
+    counted here and added to the row at every history flush, which also
+    picks up the failures and the fatal errors of the other chunks.
+    """
+    def __init__(self, issueh, max_failures=MAX_FAILURES):
+        super().__init__(max_failures)
+        self.issueh_id = issueh.pk
+        self.failures = issueh.failures
+        self.halted = issueh.halted
+        # counted since the last sync
+        self._new_failures = 0
+        self._shared_halt = None
+
+    def halt(self, reason, shared=False):
+        super().halt(reason)
+        if shared:
+            with self._lock:
+                self._shared_halt = self._shared_halt or reason
+
+    def record(self, success):
+        with self._lock:
+            if not success:
+                self.failures += 1
+                self._new_failures += 1
+            return self.exhausted
+
+    def sync(self):
+        with self._lock:
+            new_failures, self._new_failures = self._new_failures, 0
+            shared_halt, self._shared_halt = self._shared_halt, None
+        history = IssueDoiRefreshHistory.objects.filter(pk=self.issueh_id)
+        if new_failures:
+            history.update(failures=F('failures') + new_failures)
+        if shared_halt:
+            history.filter(halted__isnull=True).update(halted=shared_halt)
+        failures, halted = history.values_list('failures', 'halted').get()
+        with self._lock:
+            self.failures = failures + self._new_failures
+            if halted and self.halted is None:
+                self.halted = halted
+
+class HistoryWriter:
+    """
+    Buffers the article outcomes of one refresh job and writes them in bulk.
+
+    A pending row for every article is inserted when the job starts, so the
+    manager page shows the whole job while it runs, and outcomes are written
+    with one bulk update every `flush_interval` articles, or sooner if the
+    last write is older than `heartbeat_interval` seconds.  The progress
+    counters and the heartbeat on the issue history, and the fingerprints
+    of the payloads sent, when a `fingerprints` store is passed, are
+    written in the same transaction.  A shared failure `budget` is synced
+    at every flush as well.
+
+    The rows written so far are the job's checkpoint: when the job runs
+    again the existing rows are reused, and only the articles still pending
+    or deferred are left to refresh.
+    """
+    FIELDS = ['status', 'result', 'date_completed', *TIMED_STAGES.values()]
+    TODO = (TaskStatus.PENDING, TaskStatus.IN_PROGRESS)
+
+    def __init__(self, issueh, articles, flush_interval=None, heartbeat_interval=None, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 fingerprints=None, budget=None):
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'EZID_HISTORY_FLUSH_INTERVAL', 25)
+        if heartbeat_interval is None:
+            heartbeat_interval = getattr(settings, 'EZID_HEARTBEAT_INTERVAL', 60)
+        self.flush_interval = max(1, flush_interval)
+        self.heartbeat_interval = heartbeat_interval
+        self.issueh = issueh
+        self.fingerprints = fingerprints
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._dirty = []
+        self._last_write = time.monotonic()
+        # milliseconds taken by each batch write
+        self.write_ms = []
+        with transaction.atomic():
+            self.rows = {
+                row.article_id: row
+                for row in ArticleDoiRefreshHistory.objects.filter(
+                    issue_hist=issueh,
+                    article__in=articles,
+                ).order_by()
+            }
+            rows = ArticleDoiRefreshHistory.objects.bulk_create([
+                ArticleDoiRefreshHistory(
+                    article=article,
+                    issue_hist=issueh,
+                    date_refresh=timezone.now(),
+                )
+                for article in articles if article.pk not in self.rows
+            ])
+            self.rows.update((row.article_id, row) for row in rows)
+
+            # deferred articles are refreshed again, take them off the counters
+            deferred = [row for row in self.rows.values() if row.status == TaskStatus.DEFERRED]
+            for row in deferred:
+                row.status = TaskStatus.PENDING
+                row.result = None
+                row.date_completed = None
+            if deferred:
+                ArticleDoiRefreshHistory.objects.bulk_update(deferred, self.FIELDS)
+            self.update_counters(
+                total_articles=len(rows),
+                processed=-len(deferred),
+                deferred=-len(deferred),
+            )
+        self.resumed = len(self.rows) - len(rows)
+
+    def todo(self, articles):
+        """The articles without an outcome yet, in order"""
+        return [
+            article for article in articles
+            if self.rows[article.pk].status in self.TODO
+        ]
+
+    def update_counters(self, **increments):
+        IssueDoiRefreshHistory.objects.filter(pk=self.issueh.pk).update(
+            date_heartbeat=timezone.now(),
+            **{field: F(field) + value for field, value in increments.items()},
+        )
+
+    def record(self, article, status, result, timings=None):
+        row = self.rows[article.pk]
+        row.status = status
+        row.result = result
+        row.date_completed = timezone.now()
+        for stage, field in TIMED_STAGES.items():
+            seconds = (timings or {}).get(stage)
+            setattr(row, field, None if seconds is None else round(seconds * 1000, 3))
+        with self._lock:
+            self._dirty.append(row)
+            if (len(self._dirty) < self.flush_interval
+                    and time.monotonic() - self._last_write < self.heartbeat_interval):
+                return
+            batch, self._dirty = self._dirty, []
+        self.write(batch)
+
+    def write(self, batch):
+        if self.budget is not None:
+            self.budget.sync()
+        if not batch:
+            return
+        statuses = Counter(row.status for row in batch)
+        increments = {
+            IssueDoiRefreshHistory.STATUS_COUNTERS[status]: count
+            for status, count in statuses.items()
+        }
+        started = time.perf_counter()
+        with transaction.atomic():
+            ArticleDoiRefreshHistory.objects.bulk_update(batch, self.FIELDS)
+            if self.fingerprints is not None:
+                self.fingerprints.write()
+            self.update_counters(processed=len(batch), **increments)
+        self._last_write = time.monotonic()
+        with self._lock:
+            self.write_ms.append((time.perf_counter() - started) * 1000)
+
+    def flush(self):
+        with self._lock:
+            batch, self._dirty = self._dirty, []
+        self.write(batch)
+
+    def deferred(self):
+        return sum(row.status == TaskStatus.DEFERRED for row in self.rows.values())
+
+    def timings(self):
+        """
+        p50/p95 of each article stage over every row, earlier attempts
+        included, and of this run's batch writes, which cover many articles
+        """
+        summary = stage_timings(self.rows.values())
+        if self.write_ms:
+            summary['history_write'] = timing_summary(self.write_ms)
+        return summary
+
+    def close(self, result, status=TaskStatus.ABORTED):
+        """Marks the articles the job never got to as aborted, or `status`, and flushes"""
+        with self._lock:
+            for row in self.rows.values():
+                if row.status == TaskStatus.PENDING:
+                    row.status = status
+                    row.result = result
+                    row.date_completed = timezone.now()
+                    self._dirty.append(row)
+        self.flush()
+
+def max_job_attempts():
+    """Times an interrupted issue refresh is started again"""
+    return getattr(settings, 'EZID_MAX_JOB_ATTEMPTS', 3)
+
+def job_deadline():
+    """Seconds an issue refresh may run before the rest is deferred"""
+    return getattr(settings, 'EZID_JOB_DEADLINE', 30 * 60)
+
+class RefreshJob:
+    """State shared by every worker of one issue refresh"""
+    def __init__(self, issueh, articles, deadline=None, budget=None):
+        self.issueh = issueh
+        self.budget = budget or FailureBudget()
+        self.deadline = deadline or Deadline(job_deadline())
+        self.config_cache = JournalConfigCache()
+        # looked up and stored for all the articles at once, not one by one
+        self.fingerprints = PayloadFingerprints.for_articles(articles)
+        self.writer = HistoryWriter(
+            issueh, articles, fingerprints=self.fingerprints, budget=self.budget,
+        )
+        # when resuming, only what the earlier runs did not get to
+        self.articles = self.writer.todo(articles)
+        self.last_success = (
+            last_successes(self.articles, self.fingerprints) if issueh.incremental else {}
+        )
+
+    @property
+    def stopped(self):
+        return self.budget.exhausted or self.deadline.expired
+
 def is_refresh_okay(article):
     """
     Determines whether it is okay refresh DOI.
     """
     if article.stage != "Published":
         return False, f'Skipping. Expected stage Published, actual {article.stage}'
-    # TBD waiting for more input on date updated check
+    # articles not updated since their last refresh are skipped in incremental mode
     return True, "Okay to proceed"
 
-def refresh_article_doi(article, issueh):
+def is_modified_since(article, last_success):
     """
-    Refreshes one article DOI.
+    True unless the article and the records its metadata comes from were
+    all last modified before `last_success`.  Without a last success or a
+    modification date there is nothing to compare, so the answer is True.
     """
-    # create article history object
-    history = ArticleDoiRefreshHistory.objects.create(
-        article=article,
-        issue_hist=issueh,
-        date_refresh=timezone.now(),
+    if last_success is None:
+        return True
+    changed = last_metadata_change(article)
+    return changed is None or changed > last_success
+
+def last_successes(articles, fingerprints):
+    """
+    When each article's DOI was last deposited, or found up to date, by a
+    refresh or by any other request that stored a payload fingerprint,
+    read from the job's `fingerprints`.
+    """
+    last = dict(
+        ArticleDoiRefreshHistory.objects.filter(
+            article__in=articles,
+            status__in=[TaskStatus.SUCCESS, TaskStatus.UNCHANGED],
+        ).order_by().values('article').annotate(
+            last=Max('date_completed'),
+        ).values_list('article', 'last')
     )
-    history.save()
+    for article in articles:
+        doi = get_article_doi(article)
+        date_sent = fingerprints.date_sent(doi) if doi else None
+        if date_sent:
+            pk = article.pk
+            last[pk] = max(date_sent, last[pk]) if last.get(pk) else date_sent
+    return last
+
+def refresh_article_doi(article, issueh, config_cache=None, writer=None, budget=None, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                        last_success=None):
+    """
+    Refreshes one article DOI and records the outcome in its history row.
+    Errors that would fail every other article too halt the budget.  With
+    `last_success`, articles not modified since then are skipped.
+    """
+    if writer is None:
+        writer = HistoryWriter(issueh, [article], flush_interval=1)
     success = True # The article skipped are not counted towards failures
+    status = TaskStatus.ABORTED
+    timings = {}
     is_okay, message = is_refresh_okay(article)
+    if is_okay and not is_modified_since(article, last_success):
+        is_okay, status = False, TaskStatus.UNCHANGED
+        message = f"Skipping. Not modified since the last refresh on {last_success}"
     if is_okay:
         # skip if the article is not published or updated after publishing
         logger.info(f"Working on article {article}")
 
-        # do work for each article
-        is_done, is_doi, message = update_journal_doi(article)
+        # do work for each article, nothing is sent if the payload is unchanged
+        started = time.perf_counter()
+        config = config_cache.get(article.journal) if config_cache else None
+        timings['metadata'] = time.perf_counter() - started
+        is_done, is_doi, message = update_journal_doi(
+            article,
+            skip_unchanged=True,
+            config=config,
+            timings=timings,
+            fingerprints=writer.fingerprints,
+        )
         logger.info(f"result is is_done={is_done} and is_doi={is_doi}")
 
         success = is_done and is_doi
 
-        history.status = (
-            TaskStatus.SUCCESS if success else TaskStatus.FAILURE
-        )
-    else:
-        history.status = TaskStatus.ABORTED
+        error_class = getattr(message, 'error_class', None)
+        if error_class in HALTING_ERRORS and budget is not None:
+            budget.halt(HALTING_ERRORS[error_class], shared=True)
+
+        if message == UNCHANGED:
+            status = TaskStatus.UNCHANGED
+        elif error_class == EXPIRED:
+            # the job ran out of time, like the articles after this one
+            status = TaskStatus.DEFERRED
+            success = True
+        elif error_class == UNAVAILABLE:
+            # never sent, the circuit was open
+            status = TaskStatus.ABORTED
+        else:
+            status = TaskStatus.SUCCESS if success else TaskStatus.FAILURE
 
-    history.result = message
-    history.date_completed = timezone.now()
-    history.save()
+    writer.record(article, status, message, timings)
     return success
 
-def refresh_issue_doi(issueh_id):
+def refresh_worker(article_queue, job, results):
     """
-    Task function that Django-Q runs asynchronously to refresh DOIs.
+    Pulls articles off the shared queue until it is empty or the job
+    has failed too often.  Runs in its own thread with its own DB connection.
     """
-    logger.info(f"Running refresh_issue_doi with issueh_id={issueh_id}")
+    try:
+        with job.deadline.active():
+            while not job.stopped:
+                try:
+                    index, article = article_queue.get_nowait()
+                except queue.Empty:
+                    break
+                results[index] = refresh_article_doi(
+                    article, job.issueh, job.config_cache, job.writer, job.budget,
+                    job.last_success.get(article.pk),
+                )
+                job.budget.record(results[index])
+    finally:
+        connections.close_all()
 
+def refresh_articles(job, workers):
+    """
+    Refreshes the job's articles with up to `workers` in parallel and returns
+    the per-article results in article order, None for articles not run.
+    """
+    results = [None] * len(job.articles)
+    if workers <= 1:
+        with job.deadline.active():
+            for index, article in enumerate(job.articles):
+                if job.stopped:
+                    break
+                results[index] = refresh_article_doi(
+                    article, job.issueh, job.config_cache, job.writer, job.budget,
+                    job.last_success.get(article.pk),
+                )
+                if job.budget.record(results[index]):
+                    break
+    else:
+        article_queue = queue.Queue()
+        for item in enumerate(job.articles):
+            article_queue.put(item)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(refresh_worker, article_queue, job, results)
+                for _ in range(workers)
+            ]
+            for future in futures:
+                future.result()
+    logger.debug(
+        f"EZID config cache hits={job.config_cache.hits} misses={job.config_cache.misses}"
+    )
+    return results
+
+def run_refresh(issueh, articles, attempts, workers=None, budget=None):
+    """
+    Refreshes `articles` into the history of `issueh`, resuming from its
+    checkpoint, and returns the job and the resulting status.  `attempts`
+    counts the runs of the task, the refresh gives up once it keeps dying.
+    """
+    if workers is None:
+        workers = getattr(settings, 'EZID_REFRESH_WORKERS', 1)
+    deadline = Deadline(job_deadline())
+    job = RefreshJob(issueh, articles, deadline, budget)
+    if job.writer.resumed:
+        logger.info(
+            f"Resuming refresh of issue history {issueh.pk}, attempt {attempts}, "
+            f"{len(job.articles)} of {len(articles)} articles left"
+        )
+    if attempts > max_job_attempts():
+        # the job keeps dying, stop instead of looping on the same articles
+        job.budget.halt(f"gave up after {attempts - 1} attempts")
     try:
-        issueh = IssueDoiRefreshHistory.objects.get(id=issueh_id)
-    except IssueDoiRefreshHistory.DoesNotExist:
-        return f"Issuehistory {issueh_id} not found"
+        results = refresh_articles(job, min(workers, len(job.articles)))
+    finally:
+        if job.budget.exhausted:
+            job.writer.close(f"Not processed, {job.budget.reason}")
+        elif deadline.expired:
+            job.writer.close("Deferred, the refresh ran out of time", TaskStatus.DEFERRED)
+        else:
+            job.writer.close("Not processed, the refresh stopped early")
 
-    num_failed = 0
+    if job.budget.exhausted:
+        status = TaskStatus.FAILURE
+    elif job.writer.deferred():
+        # stopped cleanly at the deadline, the deferred articles are left to redo
+        status = TaskStatus.ABORTED
+    else:
+        # the outcome of the last article, or success if no eligible article
+        processed = [result for result in results if result is not None]
+        success = processed[-1] if processed else True
+        status = TaskStatus.SUCCESS if success else TaskStatus.FAILURE
+    return job, status
+
+def stale_window():
+    """Time without a heartbeat after which a running refresh is taken for dead"""
+    return timedelta(seconds=getattr(settings, 'EZID_STALE_AFTER', 15 * 60))
 
-    success = True # if no eligible article to publish
-    # get the list of articles
-    for article in issueh.issue.get_sorted_articles():
-        success = refresh_article_doi(article, issueh)
-        num_failed += int(not success)
+def claimable(now):
+    """A pending refresh, or one in progress whose worker stopped sending heartbeats"""
+    silent_since = now - stale_window()
+    return (
+        Q(status=TaskStatus.PENDING) |
+        Q(status=TaskStatus.IN_PROGRESS, date_heartbeat__lt=silent_since) |
+        Q(status=TaskStatus.IN_PROGRESS, date_heartbeat__isnull=True, date_refresh__lt=silent_since)
+    )
 
-        # if failed three times then stop
-        if num_failed > 3:
-            break
+def refresh_issue_doi(issueh_id, workers=None):
+    """
+    Task function that Django-Q runs asynchronously to refresh DOIs.
+    """
+    logger.info(f"Running refresh_issue_doi with issueh_id={issueh_id}")
+
+    # claim the refresh, only one worker may run it.  A Django-Q retry of a
+    # killed worker finds it in progress, and takes it over once its
+    # heartbeat is EZID_STALE_AFTER old, a retry before then leaves it to
+    # requeue_stale_refreshes
+    now = timezone.now()
+    claimed = IssueDoiRefreshHistory.objects.filter(
+        claimable(now), pk=issueh_id,
+    ).update(
+        status=TaskStatus.IN_PROGRESS,
+        attempts=F('attempts') + 1,
+        date_heartbeat=now,
+    )
+    if not claimed:
+        if not IssueDoiRefreshHistory.objects.filter(pk=issueh_id).exists():
+            return f"Issuehistory {issueh_id} not found"
+        return f"Issuehistory {issueh_id} is not pending"
+    issueh = IssueDoiRefreshHistory.objects.get(id=issueh_id)
 
-    issueh.status = TaskStatus.SUCCESS if success else TaskStatus.FAILURE
+    # get the list of articles with everything the payload needs prefetched
+    articles = load_issue_articles(issueh.issue)
+    job, status = run_refresh(issueh, articles, issueh.attempts, workers)
+
+    # only the status and timing fields, the counters belong to the history writer
+    issueh.status = status
     issueh.date_completed = timezone.now()
-    issueh.save()
+    issueh.network_seconds = job.deadline.network_seconds
+    issueh.local_seconds = job.deadline.local_seconds()
+    issueh.timings = job.writer.timings()
+    issueh.save(update_fields=[
+        'status', 'date_completed', 'network_seconds', 'local_seconds', 'timings',
+    ])
 
     logger.info(
         f"Completed Running refresh_issue_doi with issue_id={issueh_id}"
     )
     return f"DOI refresh complete for Issue {issueh_id}"
+
+# statuses of a refresh that a new request for the same issue is folded into
+ACTIVE_STATUSES = (TaskStatus.PENDING, TaskStatus.IN_PROGRESS)
+
+def claim_issue_refresh(issue_id, incremental=False, journal_job=None):
+    """
+    The pending or in progress refresh of an issue and False, or a new
+    pending one and True.  The issue row is locked until the surrounding
+    transaction ends, so concurrent triggers from other workers cannot both
+    create one.  A full refresh requested while an incremental one is
+    still pending widens the pending one instead.
+    """
+    Issue.objects.select_for_update().only('pk').get(pk=issue_id)
+    active = IssueDoiRefreshHistory.objects.filter(
+        issue_id=issue_id,
+        status__in=ACTIVE_STATUSES,
+    ).order_by('-date_refresh').first()
+    if active is not None:
+        if not incremental and active.incremental and active.status == TaskStatus.PENDING:
+            active.incremental = False
+            active.save(update_fields=['incremental'])
+        logger.info(f"DOI refresh of issue {issue_id} already queued as {active.pk}")
+        return active, False
+    issueh = IssueDoiRefreshHistory.objects.create(
+        issue_id=issue_id,
+        date_refresh=timezone.now(),
+        incremental=incremental,
+        journal_job=journal_job,
+    )
+    return issueh, True
+
+def schedule_issue_refresh(issue_id, incremental=False):
+    """
+    Queues a refresh of an issue, unless one is already pending or running.
+    Returns the issue history of the queued or already active refresh and
+    whether it was created.
+    """
+    with transaction.atomic():
+        issueh, created = claim_issue_refresh(issue_id, incremental)
+        if created:
+            # queued once the row is visible to the worker
+            transaction.on_commit(lambda: async_task(refresh_issue_doi, issueh.id))
+    return issueh, created
+
+def refresh_chunk_size():
+    """Articles in each chunk of a journal refresh"""
+    return max(1, getattr(settings, 'EZID_REFRESH_CHUNK_SIZE', 50))
+
+def schedule_journal_refresh(journal, incremental=False):
+    """
+    Queues a refresh of every issue of a journal as one job, unless one is
+    already pending or running.  Only the job is created here, the issues
+    are split into chunks by plan_journal_refresh in a worker.  Returns the
+    queued or already active job and whether it was created.
+    """
+    with transaction.atomic():
+        Journal.objects.select_for_update().only('pk').get(pk=journal.pk)
+        active = JournalDoiRefreshJob.objects.filter(
+            journal=journal,
+            status__in=ACTIVE_STATUSES,
+        ).first()
+        if active is not None:
+            logger.info(f"DOI refresh of journal {journal.pk} already queued as {active.pk}")
+            return active, False
+        job = JournalDoiRefreshJob.objects.create(
+            journal=journal,
+            incremental=incremental,
+            date_queued=timezone.now(),
+        )
+        transaction.on_commit(lambda: async_task(plan_journal_refresh, job.id))
+    return job, True
+
+def plan_journal_refresh(job_id):
+    """
+    Task function that splits a journal refresh into chunks of
+    EZID_REFRESH_CHUNK_SIZE articles of one issue and queues a task for
+    each.  Issues with a refresh of their own already queued are left out.
+    """
+    size = refresh_chunk_size()
+    chunks = []
+    with transaction.atomic():
+        claimed = JournalDoiRefreshJob.objects.filter(
+            pk=job_id, status=TaskStatus.PENDING,
+        ).update(status=TaskStatus.IN_PROGRESS)
+        if not claimed:
+            return f"Journal refresh {job_id} is not pending"
+        job = JournalDoiRefreshJob.objects.get(pk=job_id)
+
+        issues = skipped = 0
+        for issue in Issue.objects.filter(journal_id=job.journal_id).order_by('pk'):
+            issueh, created = claim_issue_refresh(issue.pk, job.incremental, journal_job=job)
+            if not created:
+                skipped += 1
+                continue
+            issues += 1
+            article_ids = [article.pk for article in issue.get_sorted_articles()]
+            chunks.extend(
+                JournalDoiRefreshChunk(
+                    job=job,
+                    issue_hist=issueh,
+                    article_ids=article_ids[start:start + size],
+                    date_queued=timezone.now(),
+                )
+                for start in range(0, len(article_ids), size)
+            )
+        chunks = JournalDoiRefreshChunk.objects.bulk_create(chunks)
+
+        job.total_chunks = len(chunks)
+        job.total_issues = issues
+        job.total_articles = sum(len(chunk.article_ids) for chunk in chunks)
+        if skipped:
+            job.result = f"{skipped} issues already being refreshed were left out"
+        job.save(update_fields=['total_chunks', 'total_issues', 'total_articles', 'result'])
+
+        chunk_ids = [chunk.pk for chunk in chunks]
+
+        def queue_chunks():
+            for chunk_id in chunk_ids:
+                async_task(refresh_journal_chunk, chunk_id)
+        transaction.on_commit(queue_chunks)
+
+    if not chunks:
+        finish_journal_refresh(job_id)
+    return f"Journal refresh {job_id} split into {len(chunks)} chunks"
+
+def refresh_journal_chunk(chunk_id, workers=None):
+    """
+    Task function that refreshes one chunk of a journal refresh, then
+    counts it towards the job and completes the job if it was the last.
+    """
+    # claim the chunk, it may have been queued more than once
+    claimed = JournalDoiRefreshChunk.objects.filter(
+        pk=chunk_id, status=TaskStatus.PENDING,
+    ).update(
+        status=TaskStatus.IN_PROGRESS,
+        attempts=F('attempts') + 1,
+        date_started=timezone.now(),
+    )
+    if not claimed:
+        return f"Journal refresh chunk {chunk_id} is not pending"
+
+    chunk = JournalDoiRefreshChunk.objects.select_related('issue_hist').get(pk=chunk_id)
+    issueh = chunk.issue_hist
+    IssueDoiRefreshHistory.objects.filter(pk=issueh.pk, status=TaskStatus.PENDING).update(
+        status=TaskStatus.IN_PROGRESS,
+    )
+
+    articles = load_articles(chunk.article_ids)
+    # the chunks of an issue stop together once the issue has failed too often
+    budget = IssueFailureBudget(issueh)
+    job, status = run_refresh(issueh, articles, chunk.attempts, workers, budget)
+    IssueDoiRefreshHistory.objects.filter(pk=issueh.pk).update(
+        network_seconds=F('network_seconds') + job.deadline.network_seconds,
+        local_seconds=F('local_seconds') + job.deadline.local_seconds(),
+    )
+
+    # fan-in, counted once even if a requeued copy of the chunk ran too
+    with transaction.atomic():
+        completed = JournalDoiRefreshChunk.objects.filter(
+            pk=chunk_id, status=TaskStatus.IN_PROGRESS,
+        ).update(status=status, date_completed=timezone.now())
+        if completed:
+            JournalDoiRefreshJob.objects.filter(pk=chunk.job_id).update(
+                completed_chunks=F('completed_chunks') + 1,
+                failed_chunks=F('failed_chunks') + int(status == TaskStatus.FAILURE),
+            )
+    finish_journal_refresh(chunk.job_id)
+    return f"Journal refresh chunk {chunk_id} {TaskStatus(status).label}"
+
+# a job or issue fails if any of its chunks failed, else aborts if any aborted
+CHUNK_STATUS_ORDER = [TaskStatus.FAILURE, TaskStatus.ABORTED, TaskStatus.SUCCESS]
+
+def combined_status(statuses):
+    statuses = set(statuses)
+    return next((status for status in CHUNK_STATUS_ORDER if status in statuses),
+                TaskStatus.SUCCESS)
+
+def finish_journal_refresh(job_id):
+    """
+    Completes a journal refresh once all its chunks are done: sets the
+    status of its issue histories and of the job from the chunk statuses,
+    and sums the article counters.  Returns whether the job was completed.
+    """
+    with transaction.atomic():
+        job = JournalDoiRefreshJob.objects.select_for_update().get(pk=job_id)
+        if job.status != TaskStatus.IN_PROGRESS or job.completed_chunks < job.total_chunks:
+            return False
+
+        chunk_statuses = {}
+        for issueh_id, status in job.chunks.values_list('issue_hist_id', 'status'):
+            chunk_statuses.setdefault(issueh_id, []).append(status)
+        rows = {}
+        for row in ArticleDoiRefreshHistory.objects.filter(
+                issue_hist__journal_job=job).only('issue_hist_id', *TIMED_STAGES.values()):
+            rows.setdefault(row.issue_hist_id, []).append(row)
+
+        now = timezone.now()
+        histories = list(job.issue_histories.all())
+        for issueh in histories:
+            issueh.status = combined_status(chunk_statuses.get(issueh.pk, []))
+            issueh.date_completed = now
+            issueh.timings = stage_timings(rows.get(issueh.pk, []))
+        IssueDoiRefreshHistory.objects.bulk_update(
+            histories, ['status', 'date_completed', 'timings'],
+        )
+
+        totals = job.issue_histories.aggregate(
+            **{field: Sum(field) for field in JournalDoiRefreshJob.COUNTERS}
+        )
+        for field, value in totals.items():
+            setattr(job, field, value or 0)
+        job.status = combined_status(issueh.status for issueh in histories)
+        job.date_completed = now
+        job.save(update_fields=['status', 'date_completed', *JournalDoiRefreshJob.COUNTERS])
+    logger.info(f"Completed journal DOI refresh {job_id}: {job.result_text()}")
+    return True
+
+def requeue_stale_refreshes():
+    """
+    Scheduled task that queues again the issue refreshes whose worker died.
+
+    A running refresh updates its heartbeat at least every
+    EZID_HEARTBEAT_INTERVAL seconds, so one that has been silent for
+    EZID_STALE_AFTER seconds is gone.  A refresh still pending after
+    EZID_STALE_PENDING_AFTER seconds was lost before it started.  Either
+    way the refresh is made pending again and resumes from its checkpoint.
+    A refresh that ran out of time is queued again to send its deferred
+    articles, up to EZID_MAX_JOB_ATTEMPTS runs, unless the issue has been
+    refreshed again since.  The chunks of journal refreshes are queued
+    again the same way.
+    """
+    now = timezone.now()
+    stale_after = stale_window()
+    pending_after = timedelta(seconds=getattr(settings, 'EZID_STALE_PENDING_AFTER', 6 * 60 * 60))
+    stale = IssueDoiRefreshHistory.objects.annotate(
+        last_seen=Coalesce('date_heartbeat', 'date_refresh'),
+    ).filter(
+        Q(status=TaskStatus.IN_PROGRESS, last_seen__lt=now - stale_after) |
+        Q(status=TaskStatus.PENDING, last_seen__lt=now - pending_after),
+        # run by the chunks of their journal refresh
+        journal_job__isnull=True,
+    ).values_list('id', 'date_heartbeat')
+
+    requeued = []
+    for issueh_id, date_heartbeat in stale:
+        # claim it, so an overlapping run of this task does not queue it twice
+        claimed = IssueDoiRefreshHistory.objects.filter(
+            pk=issueh_id, date_heartbeat=date_heartbeat,
+        ).update(status=TaskStatus.PENDING, date_heartbeat=now)
+        if claimed:
+            logger.warning(f"Requeuing stale DOI refresh, issue history {issueh_id}")
+            async_task(refresh_issue_doi, issueh_id)
+            requeued.append(issueh_id)
+
+    newer = IssueDoiRefreshHistory.objects.filter(
+        issue=OuterRef('issue'), date_refresh__gt=OuterRef('date_refresh'),
+    )
+    deferred = IssueDoiRefreshHistory.objects.filter(
+        ~Exists(newer),
+        status=TaskStatus.ABORTED,
+        deferred__gt=0,
+        attempts__lt=max_job_attempts(),
+        journal_job__isnull=True,
+    ).values_list('id', flat=True)
+    for issueh_id in deferred:
+        claimed = IssueDoiRefreshHistory.objects.filter(
+            pk=issueh_id, status=TaskStatus.ABORTED,
+        ).update(status=TaskStatus.PENDING, date_heartbeat=now)
+        if claimed:
+            logger.info(f"Requeuing the deferred articles of issue history {issueh_id}")
+            async_task(refresh_issue_doi, issueh_id)
+            requeued.append(issueh_id)
+    requeued += requeue_stale_journal_refreshes(now, stale_after, pending_after)
+    return f"Requeued {len(requeued)} stale or deferred DOI refreshes"
+
+def requeue_stale_journal_refreshes(now, stale_after, pending_after):
+    """
+    Queues again the journal refreshes never planned and the chunks that
+    were lost or whose worker died, and completes the jobs whose last
+    chunk died before completing them.  A chunk's heartbeat is the one of
+    its issue history.  Returns the requeued jobs and chunks.
+    """
+    requeued = []
+    jobs = JournalDoiRefreshJob.objects.filter(
+        status=TaskStatus.PENDING, date_queued__lt=now - pending_after,
+    ).values_list('id', 'date_queued')
+    for job_id, date_queued in jobs:
+        claimed = JournalDoiRefreshJob.objects.filter(
+            pk=job_id, status=TaskStatus.PENDING, date_queued=date_queued,
+        ).update(date_queued=now)
+        if claimed:
+            logger.warning(f"Requeuing stale journal DOI refresh {job_id}")
+            async_task(plan_journal_refresh, job_id)
+            requeued.append(job_id)
+
+    silent = Q(issue_hist__date_heartbeat__isnull=True) | Q(
+        issue_hist__date_heartbeat__lt=now - stale_after)
+    chunks = JournalDoiRefreshChunk.objects.filter(
+        Q(silent, status=TaskStatus.IN_PROGRESS, date_started__lt=now - stale_after) |
+        Q(status=TaskStatus.PENDING, date_queued__lt=now - pending_after)
+    ).values_list('id', 'status', 'date_queued')
+    for chunk_id, status, date_queued in chunks:
+        claimed = JournalDoiRefreshChunk.objects.filter(
+            pk=chunk_id, status=status, date_queued=date_queued,
+        ).update(status=TaskStatus.PENDING, date_queued=now)
+        if claimed:
+            logger.warning(f"Requeuing stale journal DOI refresh chunk {chunk_id}")
+            async_task(refresh_journal_chunk, chunk_id)
+            requeued.append(chunk_id)
+
+    for job_id in JournalDoiRefreshJob.objects.filter(
+            status=TaskStatus.IN_PROGRESS,
+            completed_chunks__gte=F('total_chunks'),
+            date_refresh__lt=now - stale_after,
+    ).values_list('id', flat=True):
+        finish_journal_refresh(job_id)
+    return requeued
+
+
+# outbox requests failing with these are tried again later, the transport
+# reports a mint that may have reached EZID as UNKNOWN, which is final
+RETRYABLE_ERRORS = (TRANSIENT, THROTTLED, UNAVAILABLE, EXPIRED)
+
+# result of a mint that may or may not have created a DOI
+MINT_UNKNOWN = "the DOI may have been minted, check EZID before minting it again"
+
+def max_outbox_attempts():
+    """Times a queued DOI request is sent before it is marked failed"""
+    return getattr(settings, 'EZID_OUTBOX_ATTEMPTS', 5)
+
+def outbox_retry_delay(attempts):
+    """Delay before the next try, doubling with every attempt"""
+    base = getattr(settings, 'EZID_OUTBOX_RETRY_DELAY', 5 * 60)
+    return timedelta(seconds=base * 2 ** (attempts - 1))
+
+def send_outbox_entry(entry_id):
+    """
+    Task function that Django-Q runs to send one queued DOI request.
+    Transient failures are put back in the outbox for drain_outbox.
+    """
+    now = timezone.now()
+    # claim the entry, it may have been queued more than once
+    claimed = EzidOutbox.objects.filter(pk=entry_id, status=TaskStatus.PENDING).update(
+        status=TaskStatus.IN_PROGRESS,
+        attempts=F('attempts') + 1,
+        date_attempted=now,
+    )
+    if not claimed:
+        return f"Outbox entry {entry_id} is not pending"
+
+    entry = EzidOutbox.objects.select_related('preprint').get(pk=entry_id)
+    try:
+        enabled, success, result = mint_preprint_doi(entry.preprint)
+        error_class = getattr(result, 'error_class', None)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logger.exception(f"Sending {entry} failed")
+        # the mint may have been sent before the error
+        error_class = UNKNOWN
+        enabled, success, result = True, False, f"error: {e}"
+
+    if error_class == UNKNOWN:
+        result = f"{result.rstrip()}, {MINT_UNKNOWN}"
+    entry.result = result
+    if success:
+        entry.status = TaskStatus.SUCCESS
+    elif not enabled:
+        entry.status = TaskStatus.ABORTED
+    elif error_class in RETRYABLE_ERRORS and entry.attempts < max_outbox_attempts():
+        entry.status = TaskStatus.PENDING
+        entry.next_attempt = now + outbox_retry_delay(entry.attempts)
+    else:
+        entry.status = TaskStatus.FAILURE
+    if entry.status != TaskStatus.PENDING:
+        entry.date_completed = timezone.now()
+    entry.save(update_fields=['status', 'result', 'next_attempt', 'date_completed'])
+    return f"Outbox entry {entry_id} {entry.get_status_display()}"
+
+def drain_outbox():
+    """
+    Scheduled task that queues the outbox entries due for another try, the
+    ones whose task was lost.  A mint whose worker died mid request may
+    have reached EZID, it is failed rather than queued again.
+    """
+    now = timezone.now()
+    EzidOutbox.objects.filter(
+        status=TaskStatus.IN_PROGRESS,
+        date_attempted__lt=now - stale_window(),
+    ).update(
+        status=TaskStatus.FAILURE,
+        result=f"error: the worker stopped while minting, {MINT_UNKNOWN}",
+        date_completed=now,
+    )
+
+    # new entries were queued when they were committed, give them a minute
+    due = EzidOutbox.objects.filter(
+        Q(next_attempt__lte=now) |
+        Q(next_attempt__isnull=True, date_created__lt=now - timedelta(minutes=1)),
+        status=TaskStatus.PENDING,
+    ).values_list('id', flat=True)
+    due = list(due)
+    for entry_id in due:
+        async_task(OUTBOX_TASK, entry_id)
+    return f"Queued {len(due)} outbox entries"
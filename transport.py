@@ -0,0 +1,511 @@
+"""
+HTTP transport for the EZID plugin.
+
+EZID requests used to build a new urllib opener, and with it a new TCP+TLS
+connection, for every DOI.  The transport below keeps a small pool of
+keep-alive connections per (endpoint_url, username) and sends Basic auth
+preemptively, so a bulk refresh pays for the handshake once.
+
+Responses come back as EzidResult strings carrying an error class.
+Transient errors are retried with jittered backoff, and a circuit breaker
+per endpoint fails requests fast while EZID is down.  Minting is not
+idempotent, so a mint is only sent again when it never reached EZID,
+otherwise its outcome is reported as unknown.  Connections have connect
+and read timeouts, and a job can bound all of its requests with a Deadline.
+"""
+
+import base64
+import contextvars
+import http.client
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from utils.logger import get_logger
+
+from plugins.ezid import metrics
+from plugins.ezid.ratelimit import get_rate_limiter, parse_retry_after
+
+logger = get_logger(__name__)
+
+# errors raised when a pooled connection was closed by the server while idle
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+# errors that mean the request never got an answer
+NETWORK_ERRORS = (OSError, http.client.HTTPException)
+
+THROTTLE_STATUS = 429
+UNAVAILABLE_STATUS = 503
+AUTH_STATUSES = (401, 403)
+TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+# error classes of an EzidResult
+TRANSIENT = "transient"
+THROTTLED = "throttled"
+AUTH = "auth"
+VALIDATION = "validation"
+UNAVAILABLE = "unavailable"
+EXPIRED = "expired"
+# a request that is not safe to repeat was sent but got no answer
+UNKNOWN = "unknown"
+
+MAX_BACKOFF = 30
+
+def max_throttle_retries():
+    ''' times a throttled request is sent again before giving up '''
+    return getattr(settings, 'EZID_THROTTLE_RETRIES', 3)
+
+def connect_timeout():
+    ''' seconds allowed to open a connection to EZID '''
+    return getattr(settings, 'EZID_CONNECT_TIMEOUT', 10)
+
+def read_timeout():
+    ''' seconds allowed between bytes of an EZID response '''
+    return getattr(settings, 'EZID_READ_TIMEOUT', 60)
+
+def max_retries():
+    ''' times a request failing with a transient error is sent again '''
+    return getattr(settings, 'EZID_MAX_RETRIES', 2)
+
+def backoff(retry):
+    ''' full jitter exponential backoff before the given retry '''
+    base = getattr(settings, 'EZID_RETRY_BACKOFF', 1.0)
+    return random.uniform(0, min(MAX_BACKOFF, base * 2 ** retry))
+
+def classify(status, retry_after=None):
+    ''' error class of a response, None for success '''
+    if status is None:
+        return TRANSIENT
+    if status == THROTTLE_STATUS or (status == UNAVAILABLE_STATUS and retry_after is not None):
+        return THROTTLED
+    if status in AUTH_STATUSES:
+        return AUTH
+    if status in TRANSIENT_STATUSES:
+        return TRANSIENT
+    if status >= 400:
+        return VALIDATION
+    return None
+
+def is_idempotent(method, path):
+    '''
+    whether sending the request twice has the same effect as sending it
+    once, true of everything but minting on a shoulder: PUT and POST on
+    id/ set the whole metadata of an identifier
+    '''
+    return method in ("GET", "HEAD", "PUT", "DELETE") or (
+        method == "POST" and path.startswith("id/"))
+
+def max_connections_per_endpoint():
+    ''' cap on concurrent requests to one EZID endpoint from this process '''
+    return getattr(settings, 'EZID_MAX_CONNECTIONS_PER_ENDPOINT', 4)
+
+
+class NotSent(Exception):
+    """A network error raised before any of the request was sent"""
+
+
+class EzidResult(str):
+    """
+    The text EZID sent back, which is what send_request always returned,
+    along with the HTTP status, the error class and the number of attempts.
+    """
+    def __new__(cls, text, status=None, error_class=None, attempts=1):
+        result = super().__new__(cls, text)
+        result.status = status
+        result.error_class = error_class
+        result.attempts = attempts
+        return result
+
+    @property
+    def ok(self):
+        return self.error_class is None
+
+    def with_text(self, text):
+        return EzidResult(text, self.status, self.error_class, self.attempts)
+
+
+class Deadline:
+    """
+    Time budget of one job, shared by its worker threads.  Requests sent
+    while a deadline is active stop once it expires, and the time they
+    spend on EZID, including backoff and rate limit waits, is added up.
+    """
+    def __init__(self, seconds=None):
+        self.started = time.monotonic()
+        self.expires = self.started + seconds if seconds else None
+        self.network_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        ''' seconds left, None without a limit '''
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def local_seconds(self):
+        return max(0.0, self.elapsed() - self.network_seconds)
+
+    def add_network_time(self, seconds):
+        with self._lock:
+            self.network_seconds += seconds
+
+    @contextmanager
+    def active(self):
+        ''' makes this the deadline of the requests sent by the current thread '''
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+
+_current_deadline = contextvars.ContextVar('ezid_deadline', default=None)
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after consecutive transient
+    failures.  Once `reset_timeout` seconds have passed a single probe
+    request is let through, and its outcome closes or reopens the circuit.
+    """
+    def __init__(self, threshold=None, reset_timeout=None):
+        if threshold is None:
+            threshold = getattr(settings, 'EZID_CIRCUIT_FAILURES', 5)
+        if reset_timeout is None:
+            reset_timeout = getattr(settings, 'EZID_CIRCUIT_RESET', 60)
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # the thread sending the probe request, None when not probing
+        self.probing = None
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.opened_at is None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing is not None or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = threading.get_ident()
+            return True
+
+    def release_probe(self):
+        ''' lets another probe through if this thread's probe got no verdict '''
+        with self._lock:
+            if self.probing == threading.get_ident():
+                self.probing = None
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("EZID responding again, closing the circuit")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = None
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f"EZID failed {self.failures} times in a row, opening the circuit")
+                self.opened_at = time.monotonic()
+
+
+class EzidTransport:
+    """A pool of keep-alive connections to one EZID endpoint for one account"""
+
+    def __init__(self, endpoint_url, username, password, max_idle=None):
+        parts = urlsplit(endpoint_url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"unknown url type: {endpoint_url}")
+        self.endpoint_url = endpoint_url
+        self.username = username
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.max_idle = max_idle or max_connections_per_endpoint()
+        self.auth_header = None
+        self.set_password(password)
+        self.limiter = get_rate_limiter(endpoint_url, username)
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self.connections_new = 0
+        self.connections_reused = 0
+        self.requests = 0
+
+    def set_password(self, password):
+        credentials = f"{self.username}:{password}".encode("UTF-8")
+        self.auth_header = f"Basic {base64.b64encode(credentials).decode('ascii')}"
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'connections_new': self.connections_new,
+                'connections_reused': self.connections_reused,
+                'connections_idle': len(self._idle),
+            }
+
+    def request_target(self, path):
+        ''' path and query sent on the request line, as urllib would send it '''
+        parts = urlsplit(f"{self.endpoint_url}/{path}")
+        return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+    def _new_connection(self):
+        if self.scheme == "https":
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=connect_timeout())
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=connect_timeout())
+        with self._lock:
+            self.connections_new += 1
+        return conn
+
+    def _checkout(self, fresh=False):
+        ''' an idle connection, or a new one if there is none or `fresh` '''
+        with self._lock:
+            if self._idle and not fresh:
+                self.connections_reused += 1
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _checkin(self, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _exchange(self, conn, method, target, body):
+        headers = {
+            "Content-Type": "text/plain; charset=UTF-8",
+            "Authorization": self.auth_header,
+            "Connection": "keep-alive",
+        }
+        if conn.sock is None:
+            try:
+                conn.connect()
+            except NETWORK_ERRORS as e:
+                raise NotSent(f"{e.__class__.__name__}: {e}") from e
+        # the connect timeout only covers the handshake
+        timeout = read_timeout()
+        deadline = current_deadline()
+        if deadline is not None and deadline.expires is not None:
+            timeout = max(0.1, min(timeout, deadline.remaining()))
+        conn.sock.settimeout(timeout)
+        conn.request(method, target, body=body, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def request(self, method, path, body):
+        '''
+        sends one request, retrying transient errors and throttling,
+        returns an EzidResult
+        '''
+        deadline = current_deadline()
+        if deadline is None:
+            return self._send(method, path, body, None)
+        started = time.monotonic()
+        try:
+            return self._send(method, path, body, deadline)
+        finally:
+            deadline.add_network_time(time.monotonic() - started)
+
+    def _send(self, method, path, body, deadline): # pylint: disable=too-many-branches,too-many-statements
+        target = self.request_target(path)
+        idempotent = is_idempotent(method, path)
+        breaker = circuit_breaker(self.endpoint_url)
+        attempts = throttles = retries = 0
+        while True:
+            if deadline is not None and deadline.expired:
+                return EzidResult(
+                    "error: the job deadline passed before EZID answered",
+                    error_class=EXPIRED,
+                    attempts=attempts,
+                )
+            if not breaker.allow():
+                return EzidResult(
+                    f"error: EZID unavailable, requests to {self.endpoint_url} suspended",
+                    error_class=UNAVAILABLE,
+                    attempts=attempts,
+                )
+            try:
+                waited = self.limiter.acquire(deadline)
+                if waited is None:
+                    return EzidResult(
+                        "error: the job deadline would pass waiting for the rate limit",
+                        error_class=EXPIRED,
+                        attempts=attempts,
+                    )
+                if waited:
+                    metrics.inc('ezid_rate_limit_waits_total')
+                    metrics.inc('ezid_rate_limit_wait_seconds_total', waited)
+                attempts += 1
+                sent = True
+                try:
+                    with endpoint_slot(self.endpoint_url):
+                        status, text, retry_after = self._request(
+                            method, target, body, idempotent)
+                except NotSent as e:
+                    status, text, retry_after = None, f"error: {e}", None
+                    sent = False
+                except NETWORK_ERRORS as e:
+                    status, text, retry_after = None, f"error: {e.__class__.__name__}: {e}", None
+                except Exception:
+                    breaker.record_failure()
+                    raise
+
+                error_class = classify(status, retry_after)
+                if error_class == THROTTLED:
+                    # EZID answered, and did not process the request
+                    breaker.record_success()
+                    metrics.inc('ezid_throttled_responses_total')
+                    if not self.limiter.throttled(retry_after, deadline):
+                        # EZID asked for a longer pause than the job has left
+                        text = "error: the job deadline would pass before EZID takes requests again"
+                        error_class = EXPIRED
+                    elif throttles < max_throttle_retries():
+                        throttles += 1
+                        logger.info(f"EZID throttled {method} {target}, retrying")
+                        continue
+                elif error_class == TRANSIENT:
+                    remaining = deadline.remaining() if deadline is not None else None
+                    if remaining != 0:
+                        breaker.record_failure()
+                    if sent and not idempotent:
+                        # EZID may have minted it, sending it again could mint a second DOI
+                        logger.warning(f"EZID {method} {target} failed after it was sent: {text}")
+                        error_class = UNKNOWN
+                    elif remaining == 0:
+                        # most likely the socket timeout we cut short for the deadline
+                        error_class = EXPIRED
+                    elif retries < max_retries() and breaker.closed:
+                        delay = backoff(retries)
+                        if remaining is not None:
+                            delay = min(delay, remaining)
+                        retries += 1
+                        logger.info(f"EZID {method} {target} failed: {text}, retry in {delay:.1f}s")
+                        time.sleep(delay)
+                        continue
+                else:
+                    # EZID answered, even if it did not like the request
+                    breaker.record_success()
+                    self.limiter.succeeded()
+                return EzidResult(text, status=status, error_class=error_class, attempts=attempts)
+            finally:
+                # a probe cut short by the deadline says nothing about EZID
+                breaker.release_probe()
+
+    def _request(self, method, target, body, idempotent=True):
+        # a request that is not safe to repeat never goes on an idle connection
+        # the server may have dropped, so it is never resent below
+        conn, reused = self._checkout(fresh=not idempotent)
+        with self._lock:
+            self.requests += 1
+        try:
+            response, data = self._exchange(conn, method, target, body)
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped the idle connection, retry once on a fresh one
+            logger.debug(f"Stale EZID connection to {self.host}, reconnecting")
+            conn = self._new_connection()
+            try:
+                response, data = self._exchange(conn, method, target, body)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        self._checkin(conn, response)
+        retry_after = None
+        if response.status in (THROTTLE_STATUS, UNAVAILABLE_STATUS):
+            retry_after = parse_retry_after(response.getheader("Retry-After"))
+        return response.status, data.decode("UTF-8"), retry_after
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_transports = {}
+_endpoint_slots = {}
+_circuit_breakers = {}
+_transports_lock = threading.Lock()
+
+def endpoint_slot(endpoint_url):
+    ''' semaphore bounding in-flight requests to an endpoint across accounts '''
+    with _transports_lock:
+        slot = _endpoint_slots.get(endpoint_url)
+        if slot is None:
+            slot = threading.BoundedSemaphore(max_connections_per_endpoint())
+            _endpoint_slots[endpoint_url] = slot
+    return slot
+
+def circuit_breaker(endpoint_url):
+    ''' the circuit breaker shared by every account on an endpoint '''
+    with _transports_lock:
+        breaker = _circuit_breakers.get(endpoint_url)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            _circuit_breakers[endpoint_url] = breaker
+    return breaker
+
+def get_transport(endpoint_url, username, password):
+    ''' returns the shared transport for an endpoint and account '''
+    key = (endpoint_url, username)
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = EzidTransport(endpoint_url, username, password)
+            _transports[key] = transport
+        else:
+            transport.set_password(password)
+    return transport
+
+def transport_stats():
+    with _transports_lock:
+        transports = list(_transports.items())
+    return {key: transport.stats() for key, transport in transports}
+
+def close_transports():
+    ''' closes and forgets every pooled connection '''
+    with _transports_lock:
+        transports = list(_transports.values())
+        _transports.clear()
+        _endpoint_slots.clear()
+        _circuit_breakers.clear()
+    for transport in transports:
+        transport.close()
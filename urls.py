@@ -27,4 +27,9 @@ urlpatterns = [
         views.issue_history,
         name="issue_history",
     ),
+    re_path(
+        r"^metrics/$",
+        views.ezid_metrics,
+        name="ezid_metrics",
+    ),
 ]
@@ -1,17 +1,26 @@
 """
 EZID plugin views module (currently placeholder)
 """
+from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
+from django.core.paginator import Paginator
+from django.db.models import OuterRef, Subquery
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect
-from django.utils import timezone
-from django_q.tasks import async_task
 
 from journal.models import Issue
 from utils.logger import get_logger
 
-from .models import IssueDoiRefreshHistory, ArticleDoiRefreshHistory
+from . import metrics
+from .models import (
+    IssueDoiRefreshHistory,
+    ArticleDoiRefreshHistory,
+    EzidOutbox,
+    JournalDoiRefreshJob,
+    TaskStatus,
+)
 from .plugin_settings import PLUGIN_NAME
-from .tasks import refresh_issue_doi
+from .tasks import schedule_issue_refresh, schedule_journal_refresh
 
 superuser_required = user_passes_test(
     lambda u: u.is_superuser,
@@ -20,38 +29,84 @@ superuser_required = user_passes_test(
 
 logger = get_logger(__name__)
 
+HISTORY_PAGE_SIZE = 50
+OUTBOX_SIZE = 20
+
+def outbox_entries(request):
+    '''
+    the queued DOI requests of the site: the repository's preprints, or
+    every request on the press site, journals have none
+    '''
+    if request.journal:
+        return EzidOutbox.objects.none()
+    repository = getattr(request, 'repository', None)
+    if repository:
+        return EzidOutbox.objects.filter(preprint__repository=repository)
+    return EzidOutbox.objects.all()
+
 @superuser_required
 def ezid_manager(request):
     template = 'ezid/manager.html'
     if request.journal:
         issues = Issue.objects.filter(journal=request.journal)
+        issueshist = IssueDoiRefreshHistory.objects.filter(issue__journal=request.journal)
+        journal_job = JournalDoiRefreshJob.objects.filter(journal=request.journal).first()
     else:
         logger.error("NO JOURNAL IN REQ")
         issues = Issue.objects.all()
+        issueshist = IssueDoiRefreshHistory.objects.all()
+        journal_job = None
 
-    issueshist = IssueDoiRefreshHistory.objects.filter(issue__in=issues)
+    # the latest history of every issue, fetched in one query
+    latest = IssueDoiRefreshHistory.objects.filter(
+        issue=OuterRef('pk')
+    ).order_by('-date_refresh', '-id')
+    issues = list(issues.annotate(latest_history_id=Subquery(latest.values('id')[:1])))
+    latest_histories = IssueDoiRefreshHistory.objects.in_bulk(
+        [issue.latest_history_id for issue in issues if issue.latest_history_id]
+    )
+    for issue in issues:
+        issue.latest_history = latest_histories.get(issue.latest_history_id)
+
+    outbox = outbox_entries(request)
+    paginator = Paginator(issueshist, HISTORY_PAGE_SIZE)
     context = {
         'plugin_name': PLUGIN_NAME,
         'issues': issues,
-        'issueshist': issueshist
+        'journal_job': journal_job,
+        'issueshist': paginator.get_page(request.GET.get('page')),
+        'outbox': outbox.select_related('preprint')[:OUTBOX_SIZE],
+        'outbox_pending': outbox.filter(
+            status__in=[TaskStatus.PENDING, TaskStatus.IN_PROGRESS]
+        ).count(),
     }
     return render(request, template, context)
 
+def is_incremental(request):
+    ''' ?incremental=1 only refreshes the articles modified since their last refresh '''
+    return request.GET.get('incremental') == '1'
+
 @superuser_required
 def trigger_issue_refresh(request, issue_id):
-    x = IssueDoiRefreshHistory.objects.create(
-        issue_id=issue_id,
-        date_refresh=timezone.now()
-    )
-    async_task(refresh_issue_doi, x.id)
+    try:
+        issueh, created = schedule_issue_refresh(issue_id, incremental=is_incremental(request))
+    except Issue.DoesNotExist as e:
+        raise Http404(f"Issue {issue_id} does not exist") from e
+    if created:
+        messages.info(request, f"DOI refresh of {issueh.issue} queued")
+    else:
+        messages.warning(request, f"A DOI refresh of {issueh.issue} is already queued")
     return redirect("ezid_manager")
 
 def issue_history(request, issuehist_id):
     template = 'ezid/issuehist_details.html'
-    articlehist = ArticleDoiRefreshHistory.objects.filter(issue_hist_id=issuehist_id)
+    articlehist = ArticleDoiRefreshHistory.objects.filter(
+        issue_hist_id=issuehist_id,
+    ).select_related('article')
 
     context = {
         'plugin_name': PLUGIN_NAME,
+        'issuehist': IssueDoiRefreshHistory.objects.filter(pk=issuehist_id).first(),
         'ahistory': articlehist
     }
     return render(request, template, context)
@@ -59,17 +114,22 @@ def issue_history(request, issuehist_id):
 @superuser_required
 def trigger_all_refresh(request):
     logger.info("In TRIGGER All")
-    issues = []
-    if request.journal:
-        issues = Issue.objects.filter(journal=request.journal)
-    else:
+    if not request.journal:
         logger.error("NO JOURNAL IN REQ")
+        return redirect("ezid_manager")
 
-    # create task for all the issues
-    for i in issues:
-        x = IssueDoiRefreshHistory.objects.create(
-            issue=i,
-            date_refresh=timezone.now()
-        )
-        async_task(refresh_issue_doi, x.id)
+    # one job for the whole journal, a worker splits it into chunks
+    job, created = schedule_journal_refresh(request.journal, incremental=is_incremental(request))
+    if created:
+        messages.info(request, "DOI refresh of all issues queued")
+    else:
+        messages.warning(request, "A DOI refresh of all issues is already queued")
     return redirect("ezid_manager")
+
+@superuser_required
+def ezid_metrics(request):
+    """The EZID metrics in the Prometheus text format"""
+    return HttpResponse(
+        metrics.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )